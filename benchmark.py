@@ -0,0 +1,215 @@
+"""benchmark - time Jollity's functions on synthetic notebooks
+
+Run `python benchmark.py --output new.json --compare old.json` to
+time each public function and the M269 processing (see `m269.py`)
+and to compare the times with those of a previous run, e.g. before a change.
+The benchmark runs offline: links point to a local web server.
+It also times `import jollity`, whose budget is checked by test_jollity.py.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# don't log the many warnings for the synthetic notebooks;
+# this must be done before importing m269, which sets up logging
+logging.basicConfig(handlers=[logging.NullHandler()])
+
+import jollity
+import m269
+import nbformat.v4 as nb4
+
+class StubServer(BaseHTTPRequestHandler):
+    """Answer all requests immediately: paths starting /missing don't exist."""
+
+    def do_HEAD(self):
+        self.send_response(404 if self.path.startswith('/missing') else 200)
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, *args):
+        pass
+
+def start_server() -> str:
+    """Start a local web server in the background and return its URL."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+def synthetic_nb(cells:int, url:str, seed:int=0):
+    """Return a notebook with about the given number of cells.
+
+    Markdown cells have headings, text with links and exponents,
+    fenced blocks and special comments. Code cells have skipped blocks,
+    timing commands and long lines.
+    """
+    rng = random.Random(seed)
+    words = 'the step takes 2 ms per item of a list of length n^2 in unit 3'
+    words = words.split()
+
+    def text(lines:int) -> str:
+        paragraph = []
+        for _ in range(lines):
+            line = ' '.join(rng.choices(words, k=rng.randint(5, 15)))
+            kind = rng.random()
+            if kind < 0.1:
+                line += f' see [M269](m269) and [page]({url}/{rng.randint(0, 50)})'
+            elif kind < 0.15:
+                line += f' and [missing]({url}/missing/{rng.randint(0, 5)})'
+            elif kind < 0.2:
+                line += '  '    # invisible line break
+            paragraph.append(line)
+        return '\n'.join(paragraph)
+
+    nb = nb4.new_notebook()
+    level = 1
+    while len(nb.cells) < cells:
+        level = max(1, min(4, level + rng.choice([-1, 0, 1])))
+        source = ['#' * level + ' Heading', text(rng.randint(1, 6))]
+        if rng.random() < 0.3:
+            source.extend(['```', text(3), '```'])
+        if rng.random() < 0.2:
+            kind = rng.choice(['NOTE', 'INFO'])
+            source.extend([f'<!-- {kind} -->', text(2), f'<!-- {kind} -->'])
+        if rng.random() < 0.2:
+            source.append('<!-- ANSWER -->')
+        source.append(text(rng.randint(1, 4)))
+        nb.cells.append(nb4.new_markdown_cell('\n'.join(source)))
+        code = [f'x = {rng.randint(0, 9)}', 'y = x * 2']
+        if rng.random() < 0.3:
+            code.extend(['# skip: draft', 'y = 0', '# /skip'])
+        if rng.random() < 0.3:
+            code.append('%timeit sorted(range(1000))')
+        if rng.random() < 0.2:
+            code.append('z = ' + ' + '.join(['x'] * 30))  # long line
+        nb.cells.append(nb4.new_code_cell('\n'.join(code)))
+    return nb
+
+def functions(url:str) -> dict:
+    """Return a map of names to functions that process a notebook."""
+    URLS = {'m269': url + '/m269'}
+    pipeline = jollity.Pipeline()
+    pipeline.add(jollity.replace_str, 'all', jollity.POWERS)
+    pipeline.add(jollity.replace_char, 'all', ('øØ·', 'ΘΘ×'))
+    pipeline.add(jollity.expand_urls, 'md:text', URLS)
+    pipeline.add(jollity.check_breaks, 'md:text')
+    pipeline.add(jollity.check_lengths, 'code', m269.MAXL)
+    return {
+        'split_md': lambda nb: jollity.split_md(nb, ['answer'], ['note', 'info']),
+        'prepend': lambda nb: jollity.prepend(nb, 'Copyright', 'markdown'),
+        'append': lambda nb: jollity.append(nb, '\nThe end.'),
+        'replace_str': lambda nb: jollity.replace_str(nb, 'all', jollity.POWERS),
+        'replace_char': lambda nb: jollity.replace_char(nb, 'all', ('ø·', 'Θ×')),
+        'replace_re': lambda nb: jollity.replace_re(nb, 'code',
+            (r'(?ms)^\s*# skip.*?# /skip\n?', '')),
+        'expand_urls': lambda nb: jollity.expand_urls(nb, 'md:text', URLS),
+        'check_breaks': lambda nb: jollity.check_breaks(nb, 'md:text'),
+        'check_levels': jollity.check_levels,
+        'check_lengths': lambda nb: jollity.check_lengths(nb, 'code', m269.MAXL),
+        'check_urls': lambda nb: jollity.check_urls(nb, 'md:text'),
+        'extract_code': jollity.extract_code,
+        'merge_cells': lambda nb: jollity.merge_cells(nb, 'md:text'),
+        'set_cells': lambda nb: jollity.set_cells(nb, 'all', False, False),
+        'remove_cells': lambda nb: jollity.remove_cells(nb, 'md:fence', ''),
+        'remove_metadata': lambda nb: jollity.remove_metadata(nb, 'all'),
+        'pipeline': pipeline.run,
+    }
+
+def time_function(function, nb, repeat:int) -> float:
+    """Return the shortest time of applying function to copies of nb."""
+    times = []
+    for _ in range(repeat):
+        notebook = copy.deepcopy(nb)
+        start = time.perf_counter()
+        function(notebook)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def time_m269(nb, repeat:int) -> float:
+    """Return the shortest time of the full M269 processing of nb."""
+    times = []
+    with tempfile.TemporaryDirectory() as folder:
+        nb_file = os.path.join(folder, 'introduction.ipynb')
+        py_file = os.path.join(folder, 'introduction.py')
+        for _ in range(repeat):
+            notebook = copy.deepcopy(nb)
+            start = time.perf_counter()
+            m269.for_execution(notebook, True, nb_file)
+            jollity.write_nb(notebook, nb_file)
+            m269.for_distribution(nb_file, py_file)
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+def time_import(repeat:int) -> float:
+    """Return the shortest time of importing jollity in a new interpreter."""
+    times = []
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(repeat):
+        # each line is 'import time: self | cumulative | module' in μs
+        report = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            'import jollity'], cwd=folder, capture_output=True, text=True)
+        for line in report.stderr.splitlines():
+            if line.endswith('| jollity'):
+                times.append(int(line.split('|')[1]) / 1e6)
+    return min(times)
+
+def run(cells:int, repeat:int) -> dict:
+    """Time all functions and return the results."""
+    url = start_server()
+    m269.URLs['m269'] = url + '/m269'
+    nb = synthetic_nb(cells, url)
+    split = copy.deepcopy(nb)
+    jollity.split_md(split, ['answer'], ['note', 'info'])
+    results = {'import': time_import(repeat)}
+    for name, function in functions(url).items():
+        # the setup function needs the original cells, the others split ones
+        source = nb if name == 'split_md' else split
+        results[name] = time_function(function, source, repeat)
+    results['m269'] = time_m269(nb, repeat)
+    return {
+        'python': platform.python_version(),
+        'cells': cells,
+        'repeat': repeat,
+        'seconds': results,
+    }
+
+def compare(new:dict, old:dict) -> None:
+    """Print the times of both runs and their ratio."""
+    print(f'{"function":<16} {"old (ms)":>10} {"new (ms)":>10} {"new/old":>8}')
+    for name, seconds in new['seconds'].items():
+        before = old['seconds'].get(name)
+        if before:
+            print(f'{name:<16} {before*1000:10.2f} {seconds*1000:10.2f} '
+                f'{seconds/before:8.2f}')
+        else:
+            print(f'{name:<16} {"":>10} {seconds*1000:10.2f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cells', type=int, default=500,
+        help='number of cells in the synthetic notebook')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of times each function is timed')
+    parser.add_argument('--output', help='JSON file to save the results')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    arguments = parser.parse_args()
+    results = run(arguments.cells, arguments.repeat)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
+    else:
+        compare(results, {'seconds': {}})
@@ -5,6 +5,20 @@
 
 ## Using Jollity
 
+### Processing many notebooks
+
+### Pipelines
+
+### Cell tables
+
+### Incremental builds
+
+### Profiling
+
+### Books
+
+### Command line
+
 ### Logging
 
 # CELL 1
@@ -17,6 +31,8 @@ logging.basicConfig(filename='log.txt')
 
 logging.basicConfig(filename='log.txt', filemode='w')
 
+### Diagnostics
+
 ## Markdown
 
 ### Cell kinds
@@ -39,6 +55,8 @@ logging.basicConfig(filename='log.txt', filemode='w')
 
 ### Replace regular expressions
 
+### Rule sets
+
 ## Extract code
 
 ## Cleanup
\ No newline at end of file
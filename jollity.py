@@ -1,12 +1,36 @@
 """jollity - a library of Jupyter notebook processing functions"""
 
-from logging import warning, error
-from nbformat import NotebookNode
+# Slow to import modules, like nbformat and urllib.request, are imported
+# by the functions that need them, so that importing jollity is fast.
+from __future__ import annotations
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
+from itertools import repeat
+from typing import NamedTuple, TYPE_CHECKING
+import bisect
+import glob
+import io
+import json
+import logging
 import math
-import nbformat
-import nbformat.v4 as nb4
+import mmap
+import operator
+import os
 import re
-import urllib.request
+import sys
+import threading
+import time
+import weakref
+
+if TYPE_CHECKING:
+    from nbformat import NotebookNode
+
+try:
+    import re._parser as _parser    # Python 3.11 or later
+except ImportError:
+    import sre_parse as _parser
 
 # maps for function `replace_str`
 POWERS = list({
@@ -26,138 +50,423 @@ COMMENT = r'(?ms)^ {0,3}<!--.*?-->'
 
 ATX = re.compile(r' {0,3}(#{1,6}) +(.+?)[ #]*$')
 
+FENCE = re.compile(r' {0,3}(`{3,}|~{3,})')
+
+# a Markdown link ](...) with a label instead of a URL starting with http
+LINK_LABEL = re.compile(r'\]\((?!http)(.+?)\)')
+
 # Internal functions
 # ------------------
 # `from jollity import *` won't import functions starting with _
 
-def _is_kind(cell, kinds:str) -> bool:
+_profile = None     # the Profile in use, if any
+_guard = None       # the RegexGuard in use, if any
+
+def _instrumented(function):
+    """Internal decorator: Record the calls of function when profiling."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profile is None:
+            return function(*args, **kwargs)
+        import inspect
+
+        parameters = inspect.signature(function).parameters
+        arguments = dict(zip(parameters, args), **kwargs)
+        return _profile.call(function, arguments)
+    return wrapper
+
+@lru_cache(maxsize=None)
+def _kinds(kinds:str) -> frozenset:
+    """Internal function: Return the set of space-separated kinds."""
+    return frozenset(kinds.split())
+
+def _is_kind(cell, kinds) -> bool:
     """Internal function: Check if cell is of one of the given kinds."""
-    if kinds == 'all' or cell.cell_type in kinds:
+    if isinstance(kinds, str):
+        kinds = _kinds(kinds)
+    if 'all' in kinds or cell.cell_type in kinds:
         return True
     if 'jollity' in cell.metadata:
-        return f'md:{cell.metadata.jollity.kind}' in kinds
+        # cells merged with metadata='union' have several kinds
+        return any('md:' + kind in kinds
+            for kind in cell.metadata.jollity.kind.split())
     return False
 
+class _KindIndex:
+    """Internal class: The positions of the cells of each kind in a notebook.
+
+    The index is valid while the notebook has the same list with the same
+    cells, in the same order. Functions that change the kinds of cells
+    without replacing them must call `_invalidate`.
+    The index also keeps the level of each heading.
+    """
+    __slots__ = ('cells', 'members', 'positions', 'selections', 'levels')
+
+    def __init__(self, cells:list):
+        self.cells = cells
+        # keep the cells themselves: ids of deleted cells may be reused
+        self.members = list(cells)
+        self.positions = {}     # kind -> list of positions of cells
+        self.selections = {}    # frozenset of kinds -> list of cells
+        self.levels = array('B', bytes(len(cells)))   # heading level or 0
+        # access the cells as dicts: attribute access is much slower
+        for position, cell in enumerate(cells):
+            kinds = [cell['cell_type']]
+            jollity = cell['metadata'].get('jollity')
+            if jollity is not None:
+                kinds.extend('md:' + kind for kind in jollity['kind'].split())
+                if 'md:head' in kinds:
+                    self.levels[position] = jollity.get('level', 0)
+            for kind in kinds:
+                self.positions.setdefault(kind, []).append(position)
+
+    def is_valid(self, cells:list) -> bool:
+        """Check if the index still describes the given cells."""
+        return (self.cells is cells and len(self.members) == len(cells) and
+            all(map(operator.is_, self.members, cells)))
+
+    def select(self, kinds:frozenset) -> list:
+        """Return the cells of the given kinds, in notebook order."""
+        if kinds not in self.selections:
+            positions = set()
+            for kind in kinds:
+                positions.update(self.positions.get(kind, []))
+            self.selections[kinds] = [
+                self.cells[position] for position in sorted(positions)]
+        return self.selections[kinds]
+
+_indexes = {}   # id(nb) -> _KindIndex, removed when the notebook is deleted
+
+def _invalidate(nb) -> None:
+    """Internal function: Discard the kind index of the notebook."""
+    if id(nb) in _indexes:
+        _indexes[id(nb)].cells = None
+
+def _index(nb) -> _KindIndex:
+    """Internal function: Return the valid kind index of the notebook."""
+    index = _indexes.get(id(nb))
+    if index is None:
+        weakref.finalize(nb, _indexes.pop, id(nb), None)
+    if index is None or not index.is_valid(nb['cells']):
+        index = _indexes[id(nb)] = _KindIndex(nb['cells'])
+    return index
+
 def _cells(nb, kinds:str) -> list:
     """Internal function: Return all cells of the given kinds."""
-    if kinds == 'all':      # handle the special case efficiently
-        return nb.cells
-    return [cell for cell in nb.cells if _is_kind(cell, kinds)]
+    kinds = _kinds(kinds)
+    if 'all' in kinds:      # handle the special case efficiently
+        return nb['cells']
+    return _index(nb).select(kinds)
+
+def _positions(nb, kinds:str) -> list:
+    """Internal function: Return (position, cell) for the cells of kinds."""
+    kinds = _kinds(kinds)
+    if 'all' in kinds:
+        return list(enumerate(nb['cells']))
+    index = _index(nb)
+    positions = set()
+    for kind in kinds:
+        positions.update(index.positions.get(kind, []))
+    return [(position, index.cells[position]) for position in sorted(positions)]
+
+def _overlap(a:str, b:str) -> bool:
+    """Internal function: Check if a and b could share characters in a text."""
+    if a in b or b in a:
+        return True
+    for length in range(1, min(len(a), len(b))):
+        if a.endswith(b[:length]) or b.endswith(a[:length]):
+            return True
+    return False
+
+def _interferes(earlier:tuple, later:tuple) -> bool:
+    """Internal function: Check if two string replacements depend on order."""
+    old1, new1 = earlier
+    old2, new2 = later
+    # removing old1 may join the text around it into old2
+    return (not old1 or not old2 or not new1 or
+        _overlap(old1, old2) or _overlap(new1, old2))
+
+def _translation(rules:list) -> dict:
+    """Internal function: Compose character replacements into one table."""
+    table = {}  # each original character -> its final replacement
+    for old, new in rules:
+        mapping = dict(zip(old, new))
+        for char, replacement in table.items():
+            table[char] = mapping.get(replacement, replacement)
+        for char, replacement in mapping.items():
+            table.setdefault(char, replacement)
+    return str.maketrans(table)
+
+def _alternation(rules:list):
+    """Internal function: Do string replacements in one scan of the text."""
+    if len(rules) == 1:
+        old, new = rules[0]
+        return lambda text: text.replace(old, new)
+    replacement = dict(rules)
+    pattern = re.compile('|'.join(re.escape(old) for old, _ in rules))
+    return partial(pattern.sub, lambda match: replacement[match.group()])
+
+class RuleSet:
+    """A sequence of replacements, compiled once to apply to many texts.
+
+    Consecutive string replacements are done in a single scan of the text and
+    consecutive character replacements with a single translation table.
+    Pairs of string replacements that would give a different result than
+    doing them one after the other are listed in `conflicts`:
+    the later replacement is done in a separate scan.
+    """
+
+    def __init__(self, what:str='S', replacements=()):
+        self.rules = []         # list of (what, old, new) in order
+        self._conflicts = []    # list of pairs of string replacements
+        self._steps = None      # list of functions from text to text
+        if replacements:
+            self.add(what, replacements)
+
+    def add(self, what:str, replacements) -> 'RuleSet':
+        """Append strings ('S'), characters ('C') or regexps ('R') to replace.
+
+        If replacements is a rule set, its rules are appended, ignoring what.
+        """
+        if isinstance(replacements, RuleSet):
+            self.rules.extend(replacements.rules)
+            replacements = []
+        elif isinstance(replacements, tuple):
+            replacements = [replacements]
+        for old, new in replacements:
+            if what == 'C' and len(old) != len(new):
+                _problem('replacement', logging.ERROR,
+                    'No 1-to-1 replacement for %s', old)
+            else:
+                self.rules.append((what, old, new))
+        self._steps = None      # compile again when next applied
+        return self
+
+    @property
+    def conflicts(self) -> list:
+        """The pairs of string replacements that must be done in order."""
+        if self._steps is None:
+            self._compile()
+        return self._conflicts
+
+    def apply(self, text:str) -> str:
+        """Return the text with all replacements done."""
+        if self._steps is None:
+            self._compile()
+        for step in self._steps:
+            text = step(text)
+        return text
+
+    def _compile(self):
+        """Internal method: Group the rules into as few steps as possible."""
+        self._steps = []
+        self._conflicts = []
+        group = []      # consecutive rules of the same kind
+        for what, old, new in self.rules + [('', '', '')]:
+            if group and (what != group[0][0] or what == 'R'):
+                self._compile_group(group)
+                group = []
+            group.append((what, old, new))
+
+    def _compile_group(self, group:list):
+        """Internal method: Compile consecutive rules of the same kind."""
+        what = group[0][0]
+        rules = [(old, new) for _, old, new in group]
+        if what == 'R':
+            old, new = rules[0]
+            self._steps.append(partial(re.compile(old).sub, new))
+        elif what == 'C':
+            table = _translation(rules)
+            self._steps.append(lambda text: text.translate(table))
+        else:
+            scan = []   # rules that can be done in one scan
+            for rule in rules:
+                for earlier in scan:
+                    if _interferes(earlier, rule):
+                        self._conflicts.append((earlier, rule))
+                        _problem('replacement', logging.INFO,
+                            'Replacing %s after %s', rule[0], earlier[0])
+                        self._steps.append(_alternation(scan))
+                        scan = []
+                        break
+                scan.append(rule)
+            self._steps.append(_alternation(scan))
+
+def _apply_rule(what:str, old:str, new:str, text:str, subn=re.subn) -> tuple:
+    """Internal function: Apply one replacement. Return new text and count."""
+    if what == 'S':
+        return text.replace(old, new), text.count(old)
+    if what == 'C':
+        count = sum(text.count(char) for char in set(old))
+        return text.translate(str.maketrans(old, new)), count
+    return subn(old, new, text)
+
+def _replace_rules(cell, position:int, rules:RuleSet):
+    """Internal function: Apply one rule at a time, to profile or guard it."""
+    subn = _guard.subn if _guard is not None else re.subn
+    text = cell.source
+    try:
+        for what, old, new in rules.rules:
+            start = time.perf_counter()
+            size = len(text)
+            text, count = _apply_rule(what, old, new, text, subn)
+            if _profile is not None:
+                _profile.rule(f'{what} {old!r}',
+                    time.perf_counter() - start, size, count, position)
+    except TimeoutError:
+        _problem('timeout', logging.ERROR,
+            'Replacing %s takes over %ss in cell %s: cell left unchanged',
+            old, _guard.budget, position, cell=position)
+    else:
+        cell.source = text
+
+def _replace_each(nb, cells:list, rules:RuleSet):
+    """Internal function: Apply the rules to each cell with `_replace_rules`."""
+    positions = {id(cell): position for position, cell in enumerate(nb.cells)}
+    for cell in cells:
+        _replace_rules(cell, positions[id(cell)], rules)
 
 def _replace(what:str, nb, kinds, replacements):
     """Internal function: Apply replacements in all cells of the given kinds."""
-    if isinstance(replacements, tuple):
-        replacements = [replacements]
-    cells = _cells(nb, kinds)
-    # do one replacement at a time on all cells to benefit from regexp caching
-    for old, new in replacements:
-        if what == 'C':
-            if len(old) != len(new):
-                error(f'No 1-to-1 replacement for {old}')
-                continue
-            else:
-                substitutions = str.maketrans(old, new)
-        for cell in cells:
-            if what == 'S':    # string substitution
-                cell.source = cell.source.replace(old, new)
-            elif what == 'C':  # character substitution
-                cell.source = cell.source.translate(substitutions)
-            else:               # regexp substitution
-                cell.source = re.sub(old, new, cell.source)
+    if isinstance(replacements, RuleSet):
+        rules = replacements
+    else:
+        rules = RuleSet(what, replacements)
+    if _profile is not None or _guard is not None:
+        _replace_each(nb, _cells(nb, kinds), rules)
+        return
+    step = 'replace ' + _describe(rules) if _memo else ''
+    for cell in _cells(nb, kinds):
+        cell.source = _memoized(step, cell, rules.apply)
 
 # Setup
 # -----
-def split_md(nb: NotebookNode, line_comments:list, block_comments:list) -> None:
-    """Split markdown cells in headings, text, fenced blocks. Remove comments."""
-    FENCE = re.compile(r' {0,3}(`{3,}|~{3,})')
-    COMMENT_START = re.compile(r' {0,3}<!--')
-    # find first --> in line with non-greedy match .*?
-    COMMENT_END = re.compile(r'.*?-->(.*)')
-
-    def close(kind, extra=dict()):
-        if lines:
-            cell = nb4.new_markdown_cell('\n'.join(lines))
-            cell.metadata = {'jollity': {'kind': kind}}
-            cell.metadata.update(old_cell.metadata)
-            if extra:
-                cell.metadata.jollity.update(extra)
-            cells.append(cell)
+@lru_cache(maxsize=None)
+def _md_patterns(line_comments:tuple, block_comments:tuple) -> tuple:
+    """Internal function: Compile the patterns to classify Markdown lines.
 
-    cells = []
-    for old_cell in nb.cells:
-        if old_cell.cell_type != 'markdown':
-            cells.append(old_cell)
-            continue
+    Return a regexp that matches a line starting a special comment
+    (group k0, k1, ... for each comment kind), another HTML comment,
+    a fenced block or a heading, and a map of each block comment kind
+    to the regexp matching its closing line.
+    """
+    alternatives = [
+        fr'(?P<k{n}>(?i: {{0,3}}<!--\s*{re.escape(kind)}\s*-->))'
+        for n, kind in enumerate(line_comments + block_comments)]
+    alternatives.extend([
+        r'(?P<comment> {0,3}<!--)',
+        r'(?P<fence> {0,3}(?P<ticks>`{3,}|~{3,}))',
+        r'(?P<head> {0,3}(?P<level>#{1,6}) +(?P<heading>.+?)[ #]*$)',
+    ])
+    ends = {kind: re.compile(fr'(?i) ? ? ?<!--\s*{re.escape(kind)}\s*-->\s*$')
+        for kind in block_comments}
+    return re.compile('|'.join(alternatives)), ends
 
-        lines = []
-        fence = ''      # the opening fence of the current fenced block
-        comment = None
-        for line in old_cell.source.split('\n'):
-            if comment == 'normal':
-                if match := COMMENT_END.match(line):
-                    comment = None
-                lines.append(line)
-            elif comment:
-                # (?i) ignores case
-                if re.match(fr'(?i) ? ? ?<!--\s*{comment}\s*-->\s*$', line):
-                    close(comment)
-                    lines = []
-                    comment = None
-                else:
-                    lines.append(line)
-            elif fence:
-                match = FENCE.match(line)
-                if match and match.group(1).startswith(fence):
-                    fence = ''
-                    lines.append(line)
-                    close('fence')
-                    lines = []
-                else:
-                    lines.append(line)
-            # line is outside comment and fenced block
-            elif COMMENT_START.match(line):
-                for kind in line_comments + block_comments:
-                    if re.match(fr'(?i)<!--\s*{kind}\s*-->', line.strip()):
-                        close('text')
-                        if kind in line_comments:
-                            lines = ['']
-                            close(kind)
-                        else:
-                            comment = kind
-                        lines = []
-                        break
-                else:   # not a special comment
-                    lines.append(line)
-                    if not COMMENT_END.match(line):
-                        comment = 'normal'
-            elif match := FENCE.match(line):
-                close('text')
-                fence = match.group(1)  # remember opening sequence of ` or ~
-                lines = [line]
-            elif match := ATX.match(line):
-                close('text')
-                lines = [line]
-                close('head', {
-                    'level': len(match.group(1)),
-                    'heading': match.group(2),
-                })
+def _md_cell(old_metadata:dict, split:int, lines:list, kind:str,
+        extra:dict=None) -> NotebookNode:
+    """Internal function: Return a Markdown cell of the given kind with lines.
+
+    The cell shares the metadata values of the cell it was split from,
+    which was at position split.
+    """
+    from nbformat import NotebookNode
+
+    metadata = NotebookNode(jollity=NotebookNode(kind=kind, split=split))
+    dict.update(metadata, old_metadata)
+    if extra:
+        metadata['jollity'] = NotebookNode(metadata['jollity'], **extra)
+    # same format as nbformat's random_cell_id, which is slower
+    return NotebookNode(id=os.urandom(4).hex(), cell_type='markdown',
+        source='\n'.join(lines), metadata=metadata)
+
+def _split_lines(cells:list, source:list, metadata:dict, split:int,
+        line_comments:tuple, block_comments:tuple) -> None:
+    """Internal function: Append the cells split from a Markdown cell.
+
+    The cell had the given source lines and metadata, and was at
+    position split.
+    """
+    LINE, ENDS = _md_patterns(line_comments, block_comments)
+    kinds = line_comments + block_comments
+
+    lines = []
+    fence = ''          # the opening fence of the current fenced block
+    comment = False     # whether inside a normal HTML comment
+    special = ''        # the kind of the current block comment
+    for line in source:
+        if comment:
+            comment = '-->' not in line
+            lines.append(line)
+        elif special:
+            if ENDS[special].match(line):
+                if lines:
+                    cells.append(_md_cell(metadata, split, lines, special))
                 lines = []
+                special = ''
             else:
                 lines.append(line)
+        elif fence:
+            lines.append(line)
+            match = FENCE.match(line)
+            if match and match.group(1).startswith(fence):
+                fence = ''
+                cells.append(_md_cell(metadata, split, lines, 'fence'))
+                lines = []
+        # line is outside comment and fenced block
+        elif not (match := LINE.match(line)):
+            lines.append(line)
+        elif match.lastgroup == 'comment':  # not a special comment
+            lines.append(line)
+            comment = '-->' not in line
+        else:
+            if lines:
+                cells.append(_md_cell(metadata, split, lines, 'text'))
+            lines = []
+            if match.lastgroup == 'fence':
+                fence = match.group('ticks')
+                lines = [line]
+            elif match.lastgroup == 'head':
+                cells.append(_md_cell(metadata, split, [line], 'head', {
+                    'level': len(match.group('level')),
+                    'heading': match.group('heading'),
+                }))
+            else:
+                kind = kinds[int(match.lastgroup[1:])]
+                if kind in line_comments:
+                    cells.append(_md_cell(metadata, split, [''], kind))
+                else:
+                    special = kind
+    if lines:
+        cells.append(_md_cell(metadata, split, lines, 'text'))
 
-        close('text')
+@_instrumented
+def split_md(nb: NotebookNode, line_comments:list, block_comments:list) -> None:
+    """Split markdown cells in headings, text, fenced blocks. Remove comments."""
+    line_comments = tuple(line_comments)
+    block_comments = tuple(block_comments)
+    cells = []
+    for split, old_cell in enumerate(nb.cells):
+        if old_cell.cell_type != 'markdown':
+            cells.append(old_cell)
+        else:
+            _split_lines(cells, old_cell.source.split('\n'),
+                old_cell['metadata'], split, line_comments, block_comments)
     nb.cells = cells
+    _invalidate(nb)
 
 # Header / Footer
 # ---------------
 
+@_instrumented
 def prepend(nb, text:str, kind:str=''):
     """Add text as first cell or at start of the current first cell."""
+    import nbformat.v4 as nb4
+
     if kind == '':
         if nb.cells:
             nb.cells[0].source = text + nb.cells[0].source
         else:
-            error("Can't prepend: empty notebook")
+            _problem('cell', logging.ERROR, "Can't prepend: empty notebook")
     elif kind == 'raw':
         nb.cells.insert(0, nb4.new_raw_cell(text))
     elif kind == 'code':
@@ -173,18 +482,21 @@ def prepend(nb, text:str, kind:str=''):
                         'heading': heading.group(2)
                     }
                 else:
-                    error(f'Not a heading: {text}')
+                    _problem('cell', logging.ERROR, 'Not a heading: %s', text)
         nb.cells.insert(0, cell)
     else:
-        error(f'Unknown kind: {kind}')
+        _problem('cell', logging.ERROR, 'Unknown kind: %s', kind)
 
+@_instrumented
 def append(nb, text:str, kind:str=''):
     """Add text as last cell or at the end of the current last cell."""
+    import nbformat.v4 as nb4
+
     if kind == '':
         if nb.cells:
             nb.cells[-1].source += text
         else:
-            error("Can't append:empty notebook")
+            _problem('cell', logging.ERROR, "Can't append:empty notebook")
     elif kind == 'raw':
         nb.cells.append(nb4.new_raw_cell(text))
     elif kind == 'code':
@@ -200,132 +512,2195 @@ def append(nb, text:str, kind:str=''):
                         'heading': heading.group(2)
                     }
                 else:
-                    error(f'Not a heading: {text}')
+                    _problem('cell', logging.ERROR, 'Not a heading: %s', text)
         nb.cells.append(cell)
     else:
-        error(f'Unknown kind: {kind}')
+        _problem('cell', logging.ERROR, 'Unknown kind: %s', kind)
 
 # Replace text
 # ------------
+@_instrumented
 def replace_str(nb, kinds:str, replacements) -> None:
     """Replace strings in all cells of the given kinds."""
     _replace('S', nb, kinds, replacements)
 
+@_instrumented
 def replace_char(nb, kinds:str, replacements) -> None:
     """Replace characters in all cells of the given kinds."""
     _replace('C', nb, kinds, replacements)
 
+@_instrumented
 def replace_re(nb, kinds:str, replacements) -> None:
     """Replace regular expressions in all cells of the given kinds."""
     _replace('R', nb, kinds, replacements)
 
-def expand_urls(nb, kinds:str, url:dict):
-    """Replace labels with URLs in Markdown links."""
-    def get_url(match) -> str:
-        label = match.group(1)
+def _scan_links(source:str) -> tuple:
+    """Internal function: Return the labels and URLs of the links in source.
+
+    Each is a list of (start, end, target), where target is source[start:end].
+    URLs start with http; labels are the other targets. The links are
+    the same as found separately by LINK_LABEL and by `\\]\\((http.+?)\\)`.
+    """
+    labels = []
+    urls = []
+    label_end = url_end = 0     # where the last label or URL link ends
+    position = source.find('](')
+    while position != -1:
+        start = position + 2
+        is_url = source.startswith('http', start)
+        # a URL has 1+ characters after http, a label has 1+ characters
+        end = source.find(')', start + (5 if is_url else 1))
+        if end == -1:
+            break
+        if source.find('\n', start, end) == -1:
+            if is_url:
+                if position >= url_end:
+                    urls.append((start, end, source[start:end]))
+                    url_end = end + 1
+            elif position >= label_end:
+                labels.append((start, end, source[start:end]))
+                label_end = end + 1
+        position = source.find('](', start)
+    return labels, urls
+
+class LinkIndex:
+    """The targets of the Markdown links in the cells of a notebook.
+
+    Each cell is scanned once for labels and URLs, and again only after
+    its source changes. Functions `expand_urls` and `check_urls` share
+    the index of each notebook, which `link_index(nb)` returns.
+    """
+
+    def __init__(self, nb):
+        # a weak reference, so that the index doesn't keep the notebook alive
+        self._nb = weakref.ref(nb)
+        self._scans = {}    # id(cell) -> (source, labels, urls)
+
+    @property
+    def nb(self):
+        """The indexed notebook."""
+        return self._nb()
+
+    def links(self, cell) -> tuple:
+        """Return the labels and URLs of the links in the cell.
+
+        Each is a list of (start, end, target) with the target's offsets
+        in the cell's source.
+        """
+        scan = self._scans.get(id(cell))
+        if scan is None or scan[0] is not cell.source:
+            if len(self._scans) > 2 * len(self.nb.cells):
+                self._scans.clear()     # forget deleted cells
+            scan = self._scans[id(cell)] = (cell.source,
+                *_scan_links(cell.source))
+        return scan[1], scan[2]
+
+    def urls(self, kinds:str) -> list:
+        """Return (cell position, offset, URL) of the links in order."""
+        positions = {id(cell): position
+            for position, cell in enumerate(self.nb.cells)}
+        return [(positions[id(cell)], start, url)
+            for cell in _cells(self.nb, kinds)
+            for start, end, url in self.links(cell)[1]]
+
+_link_indexes = {}  # id(nb) -> LinkIndex, removed when notebook is deleted
+
+def link_index(nb) -> LinkIndex:
+    """Return the link index of the notebook, creating it if needed."""
+    index = _link_indexes.get(id(nb))
+    if index is None:
+        index = _link_indexes[id(nb)] = LinkIndex(nb)
+        weakref.finalize(nb, _link_indexes.pop, id(nb), None)
+    return index
+
+def _expand_urls(source:str, url:dict, labels:list=None) -> str:
+    """Internal function: Replace labels with URLs in the links of source."""
+    if labels is None:
+        labels = _scan_links(source)[0]
+    parts = []
+    last = 0
+    for start, end, label in labels:
         if label in url:
-            return '](' + url[label] + ')'
-        else:
-            # warning(f'Unknown link label: {label}')
-            return match.group(0)   # don't change link
+            parts.append(source[last:start])
+            parts.append(url[label])
+            last = end
+        # else: warning(f'Unknown link label: {label}')
+    if not parts:
+        return source
+    parts.append(source[last:])
+    return ''.join(parts)
 
-    # match ](...) but not ](http...)
-    URL = re.compile(r'\]\((?!http)(.+?)\)')
+@_instrumented
+def expand_urls(nb, kinds:str, url:dict):
+    """Replace labels with URLs in Markdown links."""
+    index = link_index(nb)
     for cell in _cells(nb, kinds):
         if cell.cell_type == 'markdown':
-            cell.source = URL.sub(get_url, cell.source)
+            labels, _ = index.links(cell)
+            cell.source = _expand_urls(cell.source, url, labels)
+
+def link_report(notebooks:dict, kinds:str='all') -> dict:
+    """Return where each URL is linked to in a book.
+
+    Argument notebooks maps names, e.g. file names, to notebooks.
+    The result maps each URL, in order of first use, to a list of
+    (name, cell position, offset in cell source) tuples.
+    """
+    report = {}
+    for name, nb in notebooks.items():
+        for position, offset, url in link_index(nb).urls(kinds):
+            report.setdefault(url, []).append((name, position, offset))
+    return report
 
 # Check notebook
 # --------------
+def _rule_break(line:str) -> int:
+    """Internal function: Return the column of an invisible line break."""
+    return len(line.rstrip(' ')) + 1 if line.endswith('  ') else 0
+
+def _rule_length(line:str, length:int) -> int:
+    """Internal function: Return the first column beyond length."""
+    return length + 1 if len(line) > length else 0
+
+def _rule_trailing(line:str) -> int:
+    """Internal function: Return the column of trailing whitespace."""
+    stripped = len(line.rstrip())
+    return stripped + 1 if stripped < len(line) else 0
+
+def _rule_tab(line:str) -> int:
+    """Internal function: Return the column of the first tab."""
+    return line.find('\t') + 1
+
+# rules for `lint` and the line checks: name -> (function, message)
+# The function takes a line and the rule's arguments, if any, and
+# returns the column with the problem, or 0 if there's no problem.
+LINE_RULES = {
+    'break': (_rule_break, 'Invisible line break'),
+    'length': (_rule_length, 'Long line'),
+    'trailing': (_rule_trailing, 'Trailing whitespace'),
+    'tab': (_rule_tab, 'Tab character'),
+}
+
+def _check_line(rule:str, arguments:tuple, line:str) -> tuple:
+    """Internal function: Return the problem if line breaks the rule.
+
+    The problem is (rule, message template, line), as logged by the checks.
+    """
+    function, message = LINE_RULES[rule]
+    if function(line, *arguments):
+        return (rule, message + ': %s', line)
+    return None
+
+def _check_lines(source:str, check) -> list:
+    """Internal function: Return the problems of check for each line."""
+    return [problem for line in source.split('\n') if (problem := check(line))]
+
+@_instrumented
 def check_breaks(nb, kinds:str):
     """Check for invisible line breaks."""
-    for cell in _cells(nb, kinds):
-        for line in cell.source.split('\n'):
-            if line.endswith('  '):
-                warning(f'Invisible line break: {line}')
-
-def check_levels(nb):
-    """Check headings levels."""
-    previous_level = math.inf
-    for cell in _cells(nb, 'md:head'):
-        this_level = cell.metadata.jollity.level
+    check = partial(_check_lines, check=partial(_check_line, 'break', ()))
+    for position, cell in _positions(nb, kinds):
+        for rule, template, line in _memoized('breaks', cell, check):
+            _problem(rule, logging.WARNING, template, line, cell=position)
+
+@_instrumented
+def check_levels(nb, context:BookContext=None):
+    """Check headings levels.
+
+    With a context, the first heading is checked against the last heading
+    of the previous notebook checked with the same context.
+    """
+    index = _index(nb)
+    previous_level = math.inf if context is None else context.level
+    for position in index.positions.get('md:head', []):
+        this_level = index.levels[position]
         if this_level - previous_level > 1:
-            warning(f'Skipped heading level: {cell.source}')
+            _problem('levels', logging.WARNING, 'Skipped heading level: %s',
+                index.cells[position]['source'], cell=position)
         previous_level = this_level
+    if context is not None:
+        context.level = previous_level
 
+@_instrumented
 def check_lengths(nb, kinds:str, length:int):
     """Check for long lines."""
-    for cell in _cells(nb, kinds):
-        for line in cell.source.split('\n'):
-            if len(line) > length:
-                    warning(f'Long line: {line}')
+    check = partial(_check_lines,
+        check=partial(_check_line, 'length', (length,)))
+    for position, cell in _positions(nb, kinds):
+        for rule, template, line in _memoized(f'lengths {length}', cell, check):
+            _problem(rule, logging.WARNING, template, line, cell=position)
+
+class LinkChecker:
+    """Open URLs concurrently and remember the outcome for some time.
 
-def check_urls(nb, kinds:str):
+    Pass the same checker to `check_urls` for all notebooks of a book,
+    so that each URL is opened only once. If `cache` is a file name,
+    the outcomes are also kept on disk for the next runs. Failures are
+    kept for a shorter time, because they're often temporary.
+    """
+
+    def __init__(self, cache:str='', ttl:float=24*60*60, timeout:float=10,
+                 workers:int=16, per_host:int=4, failure_ttl:float=10*60):
+        self.cache = cache          # JSON file with the outcomes, if any
+        self.ttl = ttl              # seconds an outcome remains valid
+        self.failure_ttl = failure_ttl  # seconds a failure remains valid
+        self.timeout = timeout      # seconds to wait for each request
+        self.workers = workers      # maximum requests in parallel
+        self.per_host = per_host    # maximum requests in parallel per host
+        self.outcomes = {}          # url -> [time checked, error or '']
+        self._hosts = {}            # host -> semaphore limiting requests
+        self._lock = threading.Lock()
+        if cache and os.path.exists(cache):
+            self.load()
+
+    def load(self) -> None:
+        """Read the unexpired outcomes from the cache file."""
+        try:
+            with open(self.cache) as file:
+                outcomes = json.load(file)
+        except (OSError, ValueError) as e:
+            _problem('url', logging.WARNING, 'Ignoring link cache %s: %s',
+                self.cache, str(e))
+            return
+        now = time.time()
+        for url, (checked, problem) in outcomes.items():
+            if not self._expired(checked, problem, now):
+                self.outcomes[url] = [checked, problem]
+
+    def _expired(self, checked:float, problem:str, now:float) -> bool:
+        """Internal method: Check if an outcome must be checked again."""
+        return now - checked >= (self.failure_ttl if problem else self.ttl)
+
+    def save(self) -> None:
+        """Write the outcomes to the cache file."""
+        with atomic_write(self.cache) as file:
+            json.dump(self.outcomes, file)
+
+    def check(self, urls) -> dict:
+        """Return a map of the given URLs to their errors ('' if none)."""
+        now = time.time()
+        todo = [url for url in dict.fromkeys(urls)
+            if url not in self.outcomes or
+                self._expired(*self.outcomes[url], now)]
+        if todo:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(min(self.workers, len(todo))) as pool:
+                for url, problem in zip(todo, pool.map(self._open, todo)):
+                    self.outcomes[url] = [now, problem]
+            if self.cache:
+                self.save()
+        return {url: self.outcomes[url][1] for url in urls}
+
+    def _open(self, url:str) -> str:
+        """Open url with HEAD and, if that fails, with GET. Return the error."""
+        import urllib.request
+
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.Semaphore(self.per_host)
+        with self._hosts[host]:
+            try:
+                request = urllib.request.Request(url, method='HEAD')
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+                return ''
+            except Exception:
+                pass    # some servers reject HEAD, so try again with GET
+            try:
+                urllib.request.urlopen(url, timeout=self.timeout).close()
+                return ''
+            except Exception as e:
+                return str(e)
+
+@_instrumented
+def check_urls(nb, kinds:str, checker:LinkChecker=None):
     """Check for broken URLs starting with http."""
-    checked = set()     # check each distinct url once
-    for cell in _cells(nb, kinds):
-        for match in re.findall(r'\]\((http.+?)\)', cell.source):
-            if not match in checked:
-                checked.add(match)
-                try:
-                    urllib.request.urlopen(match)
-                except BaseException as e:
-                    error(f'Opening {match} raises {e}')
+    if checker is None:
+        checker = LinkChecker()
+    first = {}  # url -> position of the first cell with it
+    for position, _, url in link_index(nb).urls(kinds):
+        first.setdefault(url, position)
+    # check each distinct url once and report it in order of occurrence
+    for url, problem in checker.check(list(first)).items():
+        if problem:
+            _problem('url', logging.ERROR, 'Opening %s raises %s', url,
+                problem, cell=first[url])
+
+@_instrumented
+def lint(nb, rules:list, path:str='') -> list:
+    """Return the problems found by the rules, scanning each cell once.
+
+    Each rule is a tuple (kinds, name, arguments...) where name is a key of
+    LINE_RULES, e.g. ('code', 'length', 70). Each problem is a
+    `Diagnostic` with the line and column where the problem is.
+    """
+    selected = []   # (cells ids, function, arguments, rule name, message)
+    for kinds, name, *arguments in rules:
+        if name not in LINE_RULES:
+            _problem('lint', logging.ERROR, 'Unknown rule: %s', name)
+            continue
+        function, message = LINE_RULES[name]
+        cells = {id(cell) for cell in _cells(nb, kinds)}
+        selected.append((cells, function, arguments, name, message))
+    findings = []
+    for position, cell in enumerate(nb.cells):
+        checks = [check for check in selected if id(cell) in check[0]]
+        if not checks:
+            continue
+        for number, line in enumerate(cell.source.split('\n'), 1):
+            for _, function, arguments, name, message in checks:
+                if column := function(line, *arguments):
+                    findings.append(Diagnostic(path, position, name,
+                        logging.WARNING, message, (), number, column))
+    return findings
+
+def findings_json(findings:list) -> str:
+    """Return the findings as a JSON list of objects."""
+    return json.dumps([{'path': finding.path, 'cell': finding.cell,
+        'line': finding.line, 'column': finding.column, 'rule': finding.rule,
+        'message': finding.message} for finding in findings], indent=1)
+
+def findings_sarif(findings:list) -> str:
+    """Return the findings in SARIF format, for editors and code review tools.
+
+    A notebook's lines aren't the cells' lines, so there's no region.
+    Each location names the cell, like `cell 3`; the cell, line and column
+    are given as properties.
+    """
+    results = [{
+        'ruleId': finding.rule,
+        'level': 'error' if finding.level >= logging.ERROR else
+            'warning' if finding.level >= logging.WARNING else 'note',
+        'message': {'text': finding.message},
+        'locations': [{
+            'physicalLocation': {'artifactLocation': {'uri': finding.path}},
+            'logicalLocations': [{'name': f'cell {finding.cell}',
+                'kind': 'element'}],
+        }],
+        'properties': {'cell': finding.cell, 'line': finding.line,
+            'column': finding.column},
+    } for finding in findings]
+    rules = [{'id': name, 'shortDescription': {'text': message}}
+        for name, (_, message) in LINE_RULES.items()]
+    return json.dumps({
+        'version': '2.1.0',
+        '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+        'runs': [{
+            'tool': {'driver': {'name': 'jollity', 'rules': rules}},
+            'results': results,
+        }],
+    }, indent=1)
 
 # Extract code
 # ------------
-def extract_code(nb, headings:bool=True) -> str:
-    """Return the content of code cells and optionally the headings too."""
+MAGIC = re.compile(r'(?m)^([ \t]*)%')   # IPython magic command, e.g. %timeit
+
+def _write_code(cells, file, headings:bool, magics:bool, start:int=0,
+    prefix:str='') -> list:
+    """Internal function: write code cells and headings to a text file.
+
+    Headings before the first code cell are kept until that cell is written:
+    if there's no code cell, nothing is written, not even the prefix.
+    Return (line, cell) pairs, as explained in `write_code`.
+    """
+    pending = []                        # headings before the first code cell
     lines = []
-    counter = 1
-    for cell in nb.cells:
+    line = 1                            # the line being written, from 1
+    separator = ''                      # blank line between cells
+    for position, cell in enumerate(cells, start):
         if headings and _is_kind(cell, 'md:head'):
-            lines.extend(['', cell.source])     # blank line before heading
+            text = separator + '\n' + cell.source
+            separator = '\n'
+            if lines:
+                file.write(text)
+                line += text.count('\n')
+            else:
+                pending.append(text)
         elif cell.cell_type == 'code':
-            lines.extend(['', f'# CELL {counter}', '', cell.source])
+            if not lines:
+                file.write(prefix)
+                file.write(''.join(pending))
+                line += prefix.count('\n')
+                line += sum(text.count('\n') for text in pending)
+                pending = None
+            source = MAGIC.sub(r'\1# %', cell.source) if magics else cell.source
+            line += len(separator) + 1
+            lines.append((line, position))
+            file.write(f'{separator}\n# CELL {len(lines)}\n\n')
+            file.write(source)
+            line += 2 + source.count('\n')
+            separator = '\n'
+    return lines
+
+@_instrumented
+def write_code(nb, file, headings:bool=True, magics:bool=False) -> list:
+    """Write the content of code cells and optionally the headings to a file.
+
+    Return a list of (line, cell) pairs: the line number of each
+    `# CELL` comment, counting from 1, and the index of the cell in nb.cells.
+    """
+    return _write_code(nb.cells, file, headings, magics)
+
+@_instrumented
+def shard_code(nb, path:str, level:int=1, headings:bool=True,
+    magics:bool=False, prefix:str='') -> dict:
+    """Write the code of each section of nb to a separate file.
+
+    A section starts at each heading of the given level or higher.
+    Return a map of the files written to their (line, cell) pairs.
+    """
+    heading = re.compile(f'#{{1,{level}}}[ \t]')
+    root, extension = os.path.splitext(path)
+    sections = [0]
+    for position, cell in enumerate(nb.cells):
+        if (position and _is_kind(cell, 'md:head') and
+            heading.match(cell.source.lstrip(' '))):
+            sections.append(position)
+    sections.append(len(nb.cells))
+    files = {}
+    for start, end in zip(sections, sections[1:]):
+        cells = nb.cells[start:end]
+        if any(cell.cell_type == 'code' for cell in cells):
+            name = f'{root}-{len(files) + 1}{extension}'
+            with atomic_write(name) as file:
+                files[name] = _write_code(
+                    cells, file, headings, magics, start, prefix)
+    return files
+
+@_instrumented
+def extract_code(nb, headings:bool=True) -> str:
+    """Return the content of code cells and optionally the headings too."""
+    text = io.StringIO()
+    _write_code(nb.cells, text, headings, False)
+    return text.getvalue()
+
+def _syntax_error(source:str) -> str:
+    """Internal function: Return the error of compiling source, or ''."""
+    try:
+        compile(source, '<code>', 'exec', dont_inherit=True)
+    except SyntaxError as e:
+        return f'line {e.lineno}: {e.msg}'
+    except ValueError as e:     # the source has null characters
+        return str(e)
+    return ''
+
+def _check_cell(source:str) -> str:
+    """Internal function: Return the error of compiling a code cell, or ''."""
+    if source.lstrip().startswith('%%'):    # the cell may not be Python
+        return ''
+    return _syntax_error(MAGIC.sub(r'\1# %', source))
+
+def _code_cell(message:str, cells:list) -> str:
+    """Internal function: Replace a line number of extracted code with CELL n.
+
+    Argument cells is the list returned by `write_code`.
+    """
+    if match := re.match(r'line (\d+): ', message):
+        line = int(match.group(1))
+        counter = sum(start <= line for start, _ in cells)
+        if counter:
+            # the code of a cell starts 2 lines after its # CELL comment
+            start = cells[counter - 1][0] + 2
+            return (f'CELL {counter} line {line - start + 1}: ' +
+                message[match.end():])
+    return message
+
+@_instrumented
+def check_code(nb):
+    """Check that code cells and the code extracted from them compile."""
+    counter = 0
+    failed = False
+    for position, cell in enumerate(nb.cells):
+        if cell.cell_type == 'code':
             counter += 1
-    return '\n'.join(lines) if counter > 1 else ''
+            if message := _memoized('check_code', cell, _check_cell):
+                _problem('code', logging.WARNING,
+                    'Code does not compile: CELL %s %s', counter, message,
+                    cell=position)
+                failed = True
+    if not failed:  # the cells compile, but may not do so when put together
+        code = io.StringIO()
+        cells = write_code(nb, code, magics=True)
+        if message := _syntax_error(code.getvalue()):
+            _problem('code', logging.WARNING, 'Code does not compile: %s',
+                _code_cell(message, cells))
+
+_compiled = {}  # the SHA-256 digest of each checked file -> its errors
+
+def _check_file(path:str) -> list:
+    """Internal function: Return and log the errors of compiling a code file."""
+    with open(path, encoding='utf-8') as file:
+        code = file.read()
+    cells = [(number, 0) for number, line in enumerate(code.split('\n'), 1)
+        if line.startswith('# CELL ')]
+    errors = []
+    if message := _syntax_error(code):
+        errors.append(_code_cell(message, cells))
+        _problem('code', logging.WARNING, 'Code does not compile: %s %s',
+            path, errors[-1])
+    return errors
+
+def check_files(paths:list, jobs:int=None) -> dict:
+    """Check that code files compile, in parallel.
+
+    Return a map of each path to the list of its errors.
+    Files with the same content as already checked ones aren't checked again.
+    """
+    import hashlib
+
+    errors = {}
+    digests = {}
+    for path in paths:
+        with open(path, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        if digest in _compiled:
+            errors[path] = _compiled[digest]
+            for message in errors[path]:
+                _problem('code', logging.WARNING,
+                    'Code does not compile: %s %s', path, message)
+        else:
+            digests[path] = digest
+    for result in process_files(list(digests), _check_file, jobs):
+        errors[result.path] = result.value or []
+        if not result.error:
+            _compiled[digests[result.path]] = result.value
+    return errors
 
 # Cleanup
 # -------
-def merge_cells(nb, kinds:str):
+def _merge(run:list, metadata:str):
+    """Internal function: Merge the cells into the first one."""
+    merged = run[0]
+    merged.source = '\n'.join(cell.source for cell in run)
+    if metadata == 'first':
+        for cell in run[1:]:
+            for key, value in cell.metadata.items():
+                merged.metadata.setdefault(key, value)
+    else:
+        kinds = [cell.metadata.jollity.kind
+            for cell in run if 'jollity' in cell.metadata]
+        # the level and text of the first heading, before it's overwritten
+        heading = next(({key: cell.metadata.jollity[key]
+            for key in ('level', 'heading') if key in cell.metadata.jollity}
+            for cell in run if _is_kind(cell, 'md:head')), {})
+        for cell in run[1:]:
+            merged.metadata.update(cell.metadata)
+        if metadata == 'union' and kinds:
+            from nbformat import NotebookNode
+
+            merged.metadata.jollity = NotebookNode(merged.metadata.jollity,
+                kind=' '.join(dict.fromkeys(' '.join(kinds).split())),
+                **heading)
+    return merged
+
+@_instrumented
+def merge_cells(nb, kinds:str, metadata:str='last'):
     """Merge consecutive cells that are of the given kinds.
 
-    The merged cell has the same type as the first cell but the metadata of the last one! Needs to be improved. This is draft function.
+    The merged cell has the same type as the first cell and the metadata of
+    all cells. For the same key, the value of the last cell is kept if
+    metadata is 'last' and of the first cell if metadata is 'first'.
+    If metadata is 'union', the merged cell has the kinds of all cells.
     """
+    if metadata not in ('first', 'last', 'union'):
+        _problem('merge', logging.ERROR, 'Unknown metadata policy: %s',
+            metadata)
+        return
     cells = []
-    merged = None
-    for cell in nb.cells:
-        if not _is_kind(cell, kinds):   # cell is not to be merged
-            if merged:
-                cells.append(merged)
-                merged = None
+    run = []        # consecutive cells to be merged
+    for cell in nb.cells + [None]:
+        if cell is not None and _is_kind(cell, kinds):
+            run.append(cell)
+            continue
+        if run:
+            cells.append(_merge(run, metadata))
+            run = []
+        if cell is not None:
             cells.append(cell)
-        elif not merged:                # cell starts new merger
-            merged = cell
-        else:                           # merge this cell to previous ones
-            merged.source += '\n' + cell.source
-            merged.metadata.update(cell.metadata)
-    if merged:
-        cells.append(merged)
     nb.cells = cells
+    _invalidate(nb)
+
+@_instrumented
+def join_md(nb):
+    """Merge again the consecutive Markdown cells split from the same cell.
 
+    The merged cells no longer have any Jollity metadata.
+    """
+    cells = []
+    run = []        # consecutive cells split from the same cell
+    for cell in nb.cells + [None]:
+        split = None
+        if cell is not None and 'jollity' in cell.metadata:
+            split = cell.metadata.jollity.get('split')
+        if run and (split is None or
+                split != run[0].metadata.jollity.split):
+            merged = run[0]
+            merged.source = '\n'.join(part.source for part in run)
+            del merged.metadata['jollity']
+            cells.append(merged)
+            run = []
+        if split is not None:
+            run.append(cell)
+        elif cell is not None:
+            cells.append(cell)
+    nb.cells = cells
+    _invalidate(nb)
+
+@_instrumented
 def set_cells(nb, kinds:str='all', edit=None, delete=None) -> None:
     """Lock or unlock the given types of cells for editing or deletion."""
+    flags = {}
+    if edit is not None:
+        flags['editable'] = edit
+    if delete is not None:
+        flags['deletable'] = delete
+    # the values aren't dicts, so NotebookNode's conversions can be skipped
     for cell in _cells(nb, kinds):
-        if edit is not None:
-            cell.metadata.editable = edit
-        if delete is not None:
-            cell.metadata.deletable = delete
+        dict.update(cell['metadata'], flags)
 
+@_instrumented
 def remove_cells(nb, kinds:str, text:str):
     """Remove cells of the given kinds that contain text, given as a regexp."""
-    nb.cells = [cell for cell in nb.cells if not
-        (_is_kind(cell, kinds) and re.search(text, cell.source))]
+    if _guard is None:
+        search = re.search
+    else:
+        search = _guard.search
+    cells = []
+    for position, cell in enumerate(nb.cells):
+        try:
+            if not (_is_kind(cell, kinds) and search(text, cell.source)):
+                cells.append(cell)
+        except TimeoutError:
+            _problem('timeout', logging.ERROR,
+                'Searching %s takes over %ss in cell %s: cell not removed',
+                text, _guard.budget, position, cell=position)
+            cells.append(cell)
+    nb.cells = cells
+    _invalidate(nb)
 
+@_instrumented
 def remove_metadata(nb, kinds:str):
     """Remove Jollity's metadata from the cells of the given kinds."""
     if kinds == 'all':
-        nb.metadata.pop('jollity', '')
+        nb['metadata'].pop('jollity', '')
     for cell in _cells(nb, kinds):
-        cell.metadata.pop('jollity', '')
+        cell['metadata'].pop('jollity', '')
+    _invalidate(nb)
+
+# Reading and writing
+# -------------------
+# Notebooks with many outputs, e.g. images, are slow to read and write with
+# nbformat, which decodes and validates everything. These functions only
+# decode what Jollity processes and copy the rest unchanged from the file.
+
+# patterns to scan JSON text (as bytes)
+_SPACE = re.compile(rb'[ \t\n\r]*')
+_SCALAR = re.compile(rb'[^,}\]\s]*')
+_PLAIN = re.compile(rb'[^"{}\[\]]*')  # anything except strings and brackets
+
+# the keys of cells that Jollity processes
+_DECODED = ('cell_type', 'id', 'metadata', 'source')
+
+# The other keys of a cell are kept as JSON text in the cell's attribute _raw,
+# a dict of key -> bytes. The attribute isn't an item of the cell,
+# so nbformat ignores it, but `copy.deepcopy` copies it.
+# The text is only kept if it's as nbformat writes it: indented by one space
+# per level and without \u escapes. Otherwise, the value is decoded and
+# kept in _raw to be written as nbformat does.
+_NBFORMAT_LAYOUT = re.compile(rb'{\n "cells": (\[\]|\[\n  {\n   ")')
+
+def _string_end(data, position:int) -> int:
+    """Internal function: Return where the JSON string at position ends."""
+    end = position
+    while True:
+        end = data.find(b'"', end + 1)
+        if end < 0:
+            raise ValueError(f'Unterminated JSON string at {position}')
+        backslash = end - 1
+        while data[backslash] == ord('\\'):
+            backslash -= 1
+        if (end - backslash) % 2:   # the quote isn't escaped
+            return end + 1
+
+def _skip(data, position:int) -> int:
+    """Internal function: Return where the JSON value at position ends."""
+    char = data[position:position+1]
+    if char == b'"':
+        return _string_end(data, position)
+    if char not in (b'{', b'['):
+        return _SCALAR.match(data, position).end()
+    depth = 0
+    while True:
+        char = data[position:position+1]
+        if char == b'"':
+            position = _string_end(data, position)
+        elif char in (b'{', b'['):
+            depth += 1
+            position += 1
+        elif char in (b'}', b']'):
+            depth -= 1
+            position += 1
+            if depth == 0:
+                return position
+        else:
+            raise ValueError(f'Unexpected end of JSON at {position}')
+        position = _PLAIN.match(data, position).end()
+
+def _items(data, position:int):
+    """Internal function: Yield the start and end of each item of a JSON
+    array, or the key, start and end of each member of a JSON object."""
+    closing = b']' if data[position:position+1] == b'[' else b'}'
+    position = _SPACE.match(data, position + 1).end()
+    while data[position:position+1] != closing:
+        if closing == b'}':
+            end = _string_end(data, position)
+            key = json.loads(data[position:end])
+            position = _SPACE.match(data, end).end() + 1    # skip the :
+            position = _SPACE.match(data, position).end()
+        end = _skip(data, position)
+        if closing == b'}':
+            yield key, position, end
+        else:
+            yield position, end
+        position = _SPACE.match(data, end).end()
+        if data[position:position+1] == b',':
+            position = _SPACE.match(data, position + 1).end()
+
+def _decode(data, start:int, end:int):
+    """Internal function: Decode a JSON value into NotebookNodes."""
+    from nbformat.notebooknode import from_dict
+
+    return from_dict(json.loads(data[start:end]))
+
+def read_nb(path:str) -> NotebookNode:
+    """Read a notebook without decoding the outputs and attachments of cells.
+
+    Only the type, id, metadata and source of cells are available.
+    The other parts are kept undecoded and written unchanged by `write_nb`.
+    """
+    # the map is closed before returning: the file may then be replaced
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _read_nb(data)
+
+def _read_nb(data) -> NotebookNode:
+    """Internal function: Decode a notebook's JSON text, as for `read_nb`."""
+    from nbformat import NotebookNode
+
+    nb = NotebookNode()
+    layout = _NBFORMAT_LAYOUT.match(data) is not None
+    for key, start, end in _items(data, _SPACE.match(data).end()):
+        if key != 'cells':
+            nb[key] = _decode(data, start, end)
+            continue
+        nb.cells = []
+        for start, end in _items(data, start):
+            cell = NotebookNode()
+            raw = {}
+            decoded = {}    # the other parts, not in nbformat's layout
+            for key, start, end in _items(data, start):
+                if key in _DECODED:
+                    cell[key] = _decode(data, start, end)
+                elif layout and b'\\u' not in (text := data[start:end]):
+                    raw[key] = text
+                else:
+                    decoded[key] = _decode(data, start, end)
+            if decoded:
+                raw.update(_nbformat_parts(cell.get('cell_type'), decoded))
+            if isinstance(cell.get('source'), list):
+                cell.source = ''.join(cell.source)
+            if raw:
+                # NotebookNode would make an attribute an item of the cell
+                object.__setattr__(cell, '_raw', raw)
+            nb.cells.append(cell)
+    return nb
+
+def _nbformat_parts(cell_type:str, parts:dict) -> dict:
+    """Internal function: Return the parts of a cell with the same lines
+    of text as when nbformat reads and writes them."""
+    from nbformat.notebooknode import from_dict
+    from nbformat.v4.rwbase import rejoin_lines, split_lines
+
+    nb = from_dict({'cells': [dict(parts, cell_type=cell_type)]})
+    cell = split_lines(rejoin_lines(nb)).cells[0]
+    return {key: cell[key] for key in parts}
+
+def _write_value(file, value, indent:str):
+    """Internal function: Write value as JSON, like nbformat, at indent."""
+    text = json.dumps(value, indent=1, sort_keys=True, ensure_ascii=False)
+    file.write(text.replace('\n', '\n' + indent).encode())
+
+@contextmanager
+def atomic_write(path:str, mode:str='w', **kwargs):
+    """Open a temporary file and replace the file at path with it when done.
+
+    Use as `with atomic_write(path) as file:` to write a file that other
+    programs, like Jupyter, never see partially written. If an exception is
+    raised, the file at path is left unchanged. Other arguments are as for
+    `open`. The file keeps its permissions; a new file gets the usual ones.
+    """
+    directory, base = os.path.split(os.path.abspath(path))
+    # create the file like `open` does, so that the umask applies to it
+    flags = os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        name = os.path.join(directory, f'.{base}.{os.urandom(4).hex()}.tmp')
+        try:
+            descriptor = os.open(name, flags, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with open(descriptor, mode, **kwargs) as file:
+            yield file
+        if os.path.exists(path):
+            os.chmod(name, os.stat(path).st_mode & 0o7777)
+        os.replace(name, path)
+    except BaseException:
+        os.remove(name)
+        raise
+
+def write_nb(nb:NotebookNode, path:str) -> None:
+    """Write a notebook in the same format as nbformat, without validating it.
+
+    The outputs and attachments of cells read with `read_nb` are copied
+    unchanged, unless they were set. The file is replaced only after the
+    notebook has been written. Raise ValueError if a code cell has no outputs,
+    e.g. if it was rebuilt from a cell read with `read_nb` without them.
+    """
+    with atomic_write(path, 'wb') as file:
+        file.write(b'{\n "cells": [')
+        for number, cell in enumerate(nb.cells):
+            file.write(b',\n  {' if number else b'\n  {')
+            raw = getattr(cell, '_raw', {})
+            keys = sorted(set(cell) | set(raw))
+            if cell.get('cell_type') == 'code' and 'outputs' not in keys:
+                raise ValueError(f'Code cell {number} has no outputs')
+            for key in keys:
+                file.write(f'\n   {json.dumps(key)}: '.encode())
+                if key == 'source':
+                    _write_value(file, cell.source.splitlines(True), '   ')
+                elif key in cell:
+                    _write_value(file, cell[key], '   ')
+                elif isinstance(raw[key], bytes):
+                    file.write(raw[key])
+                else:
+                    _write_value(file, raw[key], '   ')
+                if key != keys[-1]:
+                    file.write(b',')
+            file.write(b'\n  }')
+        file.write(b'\n ]' if nb.cells else b']')
+        for key in sorted(nb):
+            if key != 'cells':
+                file.write(f',\n {json.dumps(key)}: '.encode())
+                _write_value(file, nb[key], ' ')
+        file.write(b'\n}\n')
+
+# Markdown files are converted to notebooks as by Jupytext's Markdown format,
+# without importing Jupytext: fenced blocks of Python code are code cells and
+# two blank lines start a new Markdown cell. Files that use other features of
+# the format, like a YAML header or cell options, are read with Jupytext.
+
+_MD_BLANK = re.compile(r'\s*$')
+# the fences that Jupytext reads like Jollity; other languages start code cells
+_MD_FENCE = re.compile(r'```(?:(?:py|text|console|json|toml|yaml)?\s*|python)$')
+# the lines that need Jupytext: MyST directives and Jupytext regions
+_MD_JUPYTEXT = re.compile(r'\s*(?:`{3,}|~{3,})\s*\{|<!--\s*#')
+
+def _jupytext_only(lines:list) -> bool:
+    """Internal function: Check if Markdown lines must be read with Jupytext."""
+    for line in lines:
+        if (line.startswith('```') and not _MD_FENCE.match(line) or
+                _MD_JUPYTEXT.match(line)):
+            return True
+    # Jupytext reads a shebang, an encoding and a header at the start
+    if lines and lines[0].startswith('#!') or 'coding' in ''.join(lines[:2]):
+        return True
+    for line in lines:
+        if not _MD_BLANK.match(line):
+            return line.lstrip().startswith('<!--') or line.rstrip() == '---'
+    return False
+
+def _open_quote(line:str, triple:str) -> str:
+    """Internal function: Return the triple quote still open after a line.
+
+    Argument triple is the quote open before the line, or None.
+    This is how Jupytext finds fences inside strings, which don't end cells.
+    """
+    if triple is None and line.lstrip().startswith('#'):
+        return triple
+    single = None
+    start = -1      # the position of the last triple quote
+    for position, char in enumerate(line):
+        if single is None and triple is None and char == '#':
+            break
+        if char not in '"\'' or line[position - 1:position] == '\\':
+            continue
+        if single == char:
+            single = None
+        elif single is not None:
+            pass
+        elif line[position - 2:position + 1] == 3 * char and \
+                position >= start + 3:
+            if triple == char:
+                triple = None
+                start = position
+            elif triple is None:
+                triple = char
+                start = position
+        elif triple is None:
+            single = char
+    return triple
+
+def _text_end(lines:list, start:int) -> tuple:
+    """Internal function: Find the end of the Markdown cell at start.
+
+    Return the positions, relative to start, of the line after the cell's
+    text and of the next cell, and whether two blank lines end the cell.
+    """
+    blanks = 0
+    fenced = False      # whether in a fenced block
+    indented = False    # whether in an indented code block
+    for position in range(len(lines) - start):
+        line = lines[start + position]
+        if fenced and line.startswith('```') and _MD_BLANK.match(line, 3):
+            fenced = False
+            continue
+        if blanks and line.startswith('    ') and not _MD_BLANK.match(line):
+            indented = True
+            blanks = 0
+            continue
+        if indented and not _MD_BLANK.match(line) and \
+                not line.startswith('    '):
+            indented = False
+        if indented or fenced:
+            continue
+        if line == '```python':
+            if position > 1 and blanks:
+                return position - 1, position, False
+            return position, position, False
+        if line.startswith('```'):
+            if blanks >= 2:
+                return position - 2, position, True
+            fenced = True
+            blanks = 0
+            continue
+        if _MD_BLANK.match(line):
+            blanks += 1
+        elif blanks >= 2:
+            return position - 2, position, True
+        else:
+            blanks = 0
+    return len(lines) - start, len(lines) - start, False
+
+def _md_cells(lines:list) -> list:
+    """Internal function: Return the cells of Markdown lines, as Jupytext does.
+
+    Each cell is (type, source lines, number of lines to the next cell).
+    """
+    cells = []
+    start = 0
+    while start < len(lines):
+        total = len(lines) - start
+        if lines[start] == '```python':
+            cell_type = 'code'
+            first = 1
+            end = after = total
+            explicit = False
+            triple = None
+            for position in range(1, total):
+                line = lines[start + position]
+                quoted = triple is not None
+                triple = _open_quote(line, triple)
+                if not quoted and line.startswith('```'):
+                    end, after, explicit = position, position + 1, True
+                    break
+        else:
+            cell_type = 'markdown'
+            first = 0
+            end, after, explicit = _text_end(lines, start)
+        source = lines[start + first:start + end]
+        # the next cell starts after one blank line or, if explicit, two
+        blank = [_MD_BLANK.match(line) is not None
+            for line in lines[start + after:start + after + 3]]
+        if blank[:2] == [True, False]:
+            after += 1
+        elif explicit and blank == [True, True, False]:
+            after += 2
+        if end < total:
+            gap = after - end - explicit + (after >= total)
+        else:
+            gap = 1
+        cells.append((cell_type, source, gap))
+        start += after
+    return cells
+
+def read_md(path:str, line_comments:list=None, block_comments:list=()
+        ) -> NotebookNode:
+    """Read a Markdown file as a notebook, like Jupytext does.
+
+    If line_comments is given, Markdown cells are also split while being
+    read, as by `split_md(nb, line_comments, block_comments)`.
+    """
+    from nbformat import NotebookNode
+
+    with open(path, encoding='utf-8') as file:
+        lines = file.read().splitlines()
+    if _jupytext_only(lines):
+        import jupytext
+
+        nb = jupytext.read(path)
+        # Jupytext writes notebooks without it, e.g. with `write_nb`
+        nb.metadata.jupytext.pop('text_representation', None)
+        if line_comments is not None:
+            split_md(nb, line_comments, block_comments)
+        return nb
+    cells = []
+    md_cells = _md_cells(lines)
+    for split, (cell_type, source, gap) in enumerate(md_cells):
+        metadata = NotebookNode() if gap == 1 else \
+            NotebookNode(lines_to_next_cell=gap)
+        if cell_type == 'code':
+            cells.append(NotebookNode(id=os.urandom(4).hex(),
+                cell_type='code', metadata=metadata, execution_count=None,
+                source='\n'.join(source), outputs=[]))
+        elif line_comments is None:
+            cells.append(NotebookNode(id=os.urandom(4).hex(),
+                cell_type='markdown', metadata=metadata,
+                source='\n'.join(source)))
+        else:
+            # an empty cell has one empty line, as split_md sees it
+            _split_lines(cells, source or [''], metadata, split,
+                tuple(line_comments), tuple(block_comments))
+    jupytext = NotebookNode(main_language='python') if md_cells else \
+        NotebookNode()
+    jupytext.notebook_metadata_filter = '-all'
+    jupytext.cell_metadata_filter = '-all'
+    return NotebookNode(cells=cells, metadata=NotebookNode(jupytext=jupytext),
+        nbformat=4, nbformat_minor=5)
+
+# Pipelines
+# ---------
+
+# the functions that process each cell on its own, which can be fused
+_RULES = {replace_str: 'S', replace_char: 'C', replace_re: 'R'}
+_LINES = {check_breaks: 'break', check_lengths: 'length'}
+
+@_instrumented
+def _run_fused(nb, operations:list):
+    """Internal function: Apply the fused operations to each cell in turn."""
+    kinds = set()
+    for kind, operation, payload in operations:
+        if operation == 'lines':
+            kinds.update(kind for kind, _ in payload)
+        else:
+            kinds.add(kind)
+    # find the cells of each kind only once for all operations
+    selected = {kind: {id(cell) for cell in _cells(nb, kind)} for kind in kinds}
+    for position, cell in enumerate(nb.cells):
+        key = id(cell)
+        for kind, operation, payload in operations:
+            if operation == 'lines':    # split the source once for all checks
+                checks = [check for kind, check in payload
+                    if key in selected[kind]]
+                if checks:
+                    for line in cell.source.split('\n'):
+                        for check in checks:
+                            if problem := check(line):
+                                rule, template, text = problem
+                                _problem(rule, logging.WARNING, template, text,
+                                    cell=position)
+            elif key not in selected[kind]:
+                pass
+            elif operation == 'rules':
+                if _profile is None and _guard is None:
+                    cell.source = payload.apply(cell.source)
+                else:
+                    _replace_rules(cell, position, payload)
+            elif cell.cell_type == 'markdown':  # operation == 'urls'
+                cell.source = _expand_urls(cell.source, payload)
+
+class Pipeline:
+    """A sequence of processing steps to apply to many notebooks.
+
+    Each step is a Jollity function with all its arguments except the notebook.
+    Consecutive replacements, URL expansions and line checks are fused:
+    they're applied to one cell after another, instead of one step after
+    another, so that each cell's source is processed as few times as possible.
+    Replacements of the same kinds are compiled into a single `RuleSet`.
+    Consecutive line checks split each cell into lines only once.
+    """
+
+    def __init__(self):
+        self.steps = []         # list of (function, args, kwargs)
+        self._stages = None     # the fused steps, computed on the first run
+
+    def add(self, function, *args, **kwargs) -> 'Pipeline':
+        """Append step function(nb, *args, **kwargs) to the pipeline."""
+        self.steps.append((function, args, kwargs))
+        self._stages = None
+        return self
+
+    def run(self, nb) -> None:
+        """Apply all steps to the notebook."""
+        if self._stages is None:
+            self._stages = self._fuse()
+        for stage in self._stages:
+            if isinstance(stage, list):
+                _run_fused(nb, stage)
+            else:
+                function, args, kwargs = stage
+                function(nb, *args, **kwargs)
+
+    def _fuse(self) -> list:
+        """Internal method: Group consecutive steps that can be fused."""
+        import inspect
+
+        stages = []
+        for function, args, kwargs in self.steps:
+            if function not in _RULES and function not in _LINES and \
+                    function is not expand_urls:
+                stages.append((function, args, kwargs))
+                continue
+            # bind the arguments to their names to handle keyword arguments
+            bound = inspect.signature(function).bind(None, *args, **kwargs)
+            bound.apply_defaults()
+            kinds = bound.arguments['kinds']
+            if not stages or not isinstance(stages[-1], list):
+                stages.append([])
+            operations = stages[-1]
+            last = operations[-1] if operations else (None, None, None)
+            if function in _RULES:
+                if last[:2] != (kinds, 'rules'):
+                    last = (kinds, 'rules', RuleSet())
+                    operations.append(last)
+                last[2].add(_RULES[function], bound.arguments['replacements'])
+            elif function is expand_urls:
+                operations.append((kinds, 'urls', bound.arguments['url']))
+            else:
+                arguments = ()
+                if function is check_lengths:
+                    arguments = (bound.arguments['length'],)
+                check = partial(_check_line, _LINES[function], arguments)
+                if last[1] == 'lines':
+                    last[2].append((kinds, check))
+                else:
+                    operations.append((None, 'lines', [(kinds, check)]))
+        return stages
+
+# Cell tables
+# -----------
+# For analysing or editing the cells of many notebooks at once, a CellTable
+# keeps the cells' attributes in arrays and their sources in a single string.
+# Filtering cells by kind, checking heading levels and finding long lines
+# are then done by the `re` module's C code, instead of cell by cell.
+
+class CellTable:
+    """The cells of several notebooks in columns.
+
+    For each cell (a row), the table has the index of its notebook in
+    `notebooks`, its position in the notebook, a code for its type and kinds,
+    its heading level (0 if not a heading) and the offset of its source
+    in `text`, where the sources are separated by newlines.
+    """
+
+    def __init__(self, notebooks:list):
+        self.notebooks = notebooks
+        self.notebook = array('I')  # row -> index of notebook
+        self.position = array('I')  # row -> position of cell in notebook
+        self.group = array('B')     # row -> index in groups
+        self.level = array('B')     # row -> heading level or 0
+        self.start = array('Q')     # row -> offset of cell source in text
+        self.groups = []            # list of (cell type, space-separated kinds)
+        self.changed = set()        # rows with edited sources
+        codes = {}                  # (cell type, kinds) -> index in groups
+        sources = []
+        offset = 0
+        for number, nb in enumerate(notebooks):
+            for position, cell in enumerate(nb.cells):
+                jollity = cell.metadata.get('jollity', {})
+                group = (cell.cell_type, jollity.get('kind', ''))
+                if group not in codes:
+                    if len(codes) == 256:
+                        raise ValueError('More than 256 cell kinds')
+                    codes[group] = len(self.groups)
+                    self.groups.append(group)
+                self.notebook.append(number)
+                self.position.append(position)
+                self.group.append(codes[group])
+                self.level.append(jollity.get('level', 0)
+                    if 'head' in group[1].split() else 0)
+                self.start.append(offset)
+                sources.append(cell.source)
+                offset += len(cell.source) + 1
+        self.text = '\n'.join(sources)
+
+    def __len__(self) -> int:
+        return len(self.group)
+
+    def cell(self, row:int):
+        """Return the cell in the given row."""
+        return self.notebooks[self.notebook[row]].cells[self.position[row]]
+
+    def source(self, row:int) -> str:
+        """Return the source of the cell in the given row."""
+        end = self.start[row + 1] - 1 if row + 1 < len(self) else None
+        return self.text[self.start[row]:end]
+
+    def _mask(self, kinds:str) -> bytes:
+        """Internal method: Return 1 for each row of the given kinds, else 0."""
+        kinds = _kinds(kinds)
+        table = bytes('all' in kinds or cell_type in kinds or
+            any('md:' + kind in kinds for kind in kind.split())
+            for cell_type, kind in self.groups).ljust(256, b'\0')
+        return self.group.tobytes().translate(table)
+
+    def select(self, kinds:str) -> list:
+        """Return the rows of the cells of the given kinds, in order."""
+        return [match.start()
+            for match in re.finditer(b'\1', self._mask(kinds))]
+
+    def replace(self, what:str, kinds:str, replacements) -> None:
+        """Replace strings ('S'), characters ('C') or regexps ('R') in cells.
+
+        The arguments are as for the replace functions.
+        The notebooks aren't changed until `write_back` is called.
+        """
+        if not isinstance(replacements, RuleSet):
+            replacements = RuleSet(what, replacements)
+        mask = self._mask(kinds)
+        sources = [self.source(row) for row in range(len(self))]
+        offset = 0
+        for row, source in enumerate(sources):
+            if mask[row]:
+                new = replacements.apply(source)
+                if new != source:
+                    sources[row] = source = new
+                    self.changed.add(row)
+            self.start[row] = offset
+            offset += len(source) + 1
+        self.text = '\n'.join(sources)
+
+    def check_levels(self) -> None:
+        """Check headings levels, like `check_levels`, in each notebook."""
+        previous_level = math.inf
+        previous_notebook = -1
+        for row in self.select('md:head'):
+            if self.notebook[row] != previous_notebook:
+                previous_level = math.inf
+                previous_notebook = self.notebook[row]
+            if self.level[row] - previous_level > 1:
+                _problem('levels', logging.WARNING, 'Skipped heading level: %s',
+                    self.source(row), cell=self.position[row])
+            previous_level = self.level[row]
+
+    def check_lengths(self, kinds:str, length:int) -> None:
+        """Check for long lines, like `check_lengths`."""
+        mask = self._mask(kinds)
+        for match in re.finditer(f'(?m)^.{{{length + 1},}}$', self.text):
+            row = bisect.bisect_right(self.start, match.start()) - 1
+            if mask[row]:
+                _problem('length', logging.WARNING, 'Long line: %s',
+                    match.group(), cell=self.position[row])
+
+    def write_back(self) -> None:
+        """Put the edited sources in the notebooks' cells."""
+        for row in sorted(self.changed):
+            self.cell(row).source = self.source(row)
+        self.changed.clear()
+
+# Incremental builds
+# ------------------
+
+def _describe(item) -> str:
+    """Internal function: Return a text that changes with item's behaviour."""
+    import inspect
+
+    if (inspect.ismodule(item) or inspect.isclass(item) or
+            inspect.isroutine(item)):
+        try:
+            return inspect.getsource(inspect.unwrap(item))
+        except (OSError, TypeError):    # e.g. built-in functions
+            return repr(item)
+    if isinstance(item, partial):
+        return _describe([item.func, item.args, item.keywords])
+    if isinstance(item, RuleSet):
+        return repr(item.rules)
+    if isinstance(item, Pipeline):
+        return _describe(item.steps)
+    if isinstance(item, LinkChecker):
+        # the outcomes are what a run found, not how it checks
+        return 'LinkChecker' + _describe({key: value
+            for key, value in vars(item).items()
+            if key != 'outcomes' and not key.startswith('_')})
+    if isinstance(item, BookContext):
+        # the level and code files change while processing a book
+        return 'BookContext' + _describe(item.checker)
+    if isinstance(item, (list, tuple)):
+        return '[' + ', '.join(_describe(element) for element in item) + ']'
+    if isinstance(item, dict):
+        return '{' + ', '.join(f'{_describe(key)}: {_describe(value)}'
+            for key, value in item.items()) + '}'
+    if type(item).__repr__ is object.__repr__:
+        # the default text has the object's address, which changes every run
+        raise TypeError(f"Can't describe a {type(item).__name__} object")
+    return repr(item)
+
+def fingerprint(*items) -> str:
+    """Return a hash of how notebooks are processed.
+
+    The items can be functions (hashed by their source code), pipelines,
+    rule sets, replacement lists, URL dictionaries, link checkers, book
+    contexts and other values. The hash also depends on Jollity's own
+    source code. Raise TypeError for objects that can't be described
+    by the same text in every run.
+    """
+    import hashlib
+
+    digest = hashlib.sha256(_describe(sys.modules[__name__]).encode())
+    for item in items:
+        digest.update(_describe(item).encode())
+    return digest.hexdigest()
+
+class BuildCache:
+    """Keep the files generated from each source to reuse them in later runs.
+
+    The files are reused only if the source's content and the fingerprint
+    of the processing are the same as when the files were stored.
+    The problems found when generating the files can be stored too,
+    to report them again when the files are reused. Only the files stored
+    last for each source are kept.
+    """
+    PROBLEMS = '.problems.json'     # the file with the stored problems
+
+    def __init__(self, directory:str='.jollity', fingerprint:str=''):
+        self.directory = directory
+        self.fingerprint = fingerprint
+
+    def _folder(self, source:str) -> str:
+        """Internal method: Return the folder of the files made from source.
+
+        It's in a folder for the source, next to the folders of the files
+        made from other versions of the source or by other processing.
+        """
+        import hashlib
+
+        place = hashlib.sha256(os.path.abspath(source).encode())
+        digest = hashlib.sha256(self.fingerprint.encode())
+        with open(source, 'rb') as file:
+            digest.update(file.read())
+        return os.path.join(self.directory, place.hexdigest(),
+            digest.hexdigest())
+
+    def restore(self, source:str, targets:list) -> bool:
+        """Copy the stored files to targets if possible. Return if it was."""
+        import shutil
+
+        folder = self._folder(source)
+        cached = [os.path.join(folder, os.path.basename(target))
+            for target in targets]
+        if not all(os.path.exists(file) for file in cached):
+            _problem('cache', logging.INFO, 'Build cache miss: %s', source)
+            return False
+        for file, target in zip(cached, targets):
+            with open(file, 'rb') as stored, atomic_write(target, 'wb') as copy:
+                shutil.copyfileobj(stored, copy)
+        _problem('cache', logging.INFO, 'Build cache hit: %s', source)
+        problems = os.path.join(folder, self.PROBLEMS)
+        if os.path.exists(problems):
+            found = Diagnostics(source)
+            with open(problems, encoding='utf-8') as file:
+                for rule, level, template, args, cell, count in json.load(file):
+                    for _ in range(count):
+                        found.add(rule, level, template, tuple(args), cell)
+            _report_problems(found)
+        return True
+
+    def store(self, source:str, targets:list, problems:Diagnostics=None
+            ) -> None:
+        """Keep a copy of the files generated from source.
+
+        Keep also the problems found while generating them, if given.
+        """
+        import shutil
+        import tempfile
+
+        folder = self._folder(source)
+        parent = os.path.dirname(folder)
+        os.makedirs(parent, exist_ok=True)
+        # fill a temporary folder and rename it when done, so that an
+        # interrupted store leaves no partial files to be reused
+        temporary = tempfile.mkdtemp(prefix='.', dir=parent)
+        try:
+            for target in targets:
+                shutil.copyfile(target,
+                    os.path.join(temporary, os.path.basename(target)))
+            if problems is not None:
+                with open(os.path.join(temporary, self.PROBLEMS), 'w',
+                        encoding='utf-8') as file:
+                    # values that JSON can't represent are stored as text
+                    json.dump([[found.rule, found.level, found.template,
+                        found.args, found.cell, count]
+                        for found, count in problems.counts.items()],
+                        file, default=str)
+            # remove the files stored earlier, which can't be reused anymore
+            for name in os.listdir(parent):
+                if not name.startswith('.'):
+                    shutil.rmtree(os.path.join(parent, name))
+            os.replace(temporary, folder)
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+
+# Memoization
+# ------------
+
+class Memo:
+    """The results of processing cells, to reuse for cells with the same source.
+
+    Keeps up to `size` results in memory, discarding the least recently used,
+    and all results in file `path`, if given. The results in the file are
+    only reused by the same version of Jollity.
+    """
+
+    def __init__(self, size:int=10000, path:str=''):
+        self.size = size
+        self.fingerprint = fingerprint()    # of Jollity's code
+        self.results = OrderedDict()    # key -> result, most recent last
+        self.store = None
+        if path:
+            import shelve
+
+            self.store = shelve.open(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, step:str, cell, compute):
+        """Return compute(cell.source), reusing the result if possible."""
+        import hashlib
+
+        digest = hashlib.sha256(self.fingerprint.encode())
+        digest.update(b'\0' + step.encode())
+        kind = cell.metadata.get('jollity', {}).get('kind', '')
+        for part in (cell.cell_type, kind, cell.source):
+            digest.update(b'\0' + part.encode())
+        key = digest.hexdigest()
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+        if self.store is not None and key in self.store:
+            result = self.store[key]
+            self.hits += 1
+        else:
+            result = compute(cell.source)
+            self.misses += 1
+            if self.store is not None:
+                self.store[key] = result
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return result
+
+    def close(self) -> None:
+        """Write the results to the file, if any."""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+_memo = None    # the Memo in use, if any
+
+def _memoized(step:str, cell, compute):
+    """Internal function: Return compute(cell.source), memoized if enabled."""
+    if _memo is None:
+        return compute(cell.source)
+    return _memo.get(step, cell, compute)
+
+@contextmanager
+def memoize(size:int=10000, path:str=''):
+    """Reuse results of replacements and checks of cells with the same source.
+
+    Use as `with memoize() as memo:` around the processing of notebooks.
+    """
+    global _memo
+    previous = _memo
+    _memo = Memo(size, path)
+    try:
+        yield _memo
+    finally:
+        _memo.close()
+        _memo = previous
+
+# Profiling
+# ---------
+
+class Profile:
+    """Statistics of the calls of Jollity's functions and of each replacement.
+
+    For each function, kinds of cells and replacement rule, it records
+    the number of calls, the time taken, the cells and characters processed
+    and the substitutions made.
+    """
+
+    def __init__(self, budget:float=1.0):
+        self.budget = budget    # seconds for a replacement on a single cell
+        self.stats = {}         # (function, kinds, rule) -> [calls, seconds,
+                                # cells, characters, substitutions]
+        self.events = []        # Chrome trace events of the function calls
+        self._start = time.perf_counter()
+        self._current = None    # the key of the function being called
+        self._substitutions = 0 # made by the function being called
+
+    def _add(self, key:tuple, seconds:float, cells:int, size:int, count:int):
+        """Internal method: Add to the statistics of key."""
+        stats = self.stats.setdefault(key, [0, 0.0, 0, 0, 0])
+        for index, value in enumerate([1, seconds, cells, size, count]):
+            stats[index] += value
+
+    def call(self, function, arguments:dict):
+        """Call function with the arguments and record the statistics."""
+        kinds = arguments.get('kinds', 'all')
+        nb = arguments.get('nb')
+        cells = _cells(nb, kinds) if isinstance(nb, dict) else []
+        size = sum(len(cell.source) for cell in cells)
+        outer = self._current, self._substitutions
+        self._current = key = (function.__name__, kinds, '')
+        self._substitutions = 0
+        start = time.perf_counter()
+        try:
+            return function(**arguments)
+        finally:
+            seconds = time.perf_counter() - start
+            substitutions = self._substitutions
+            self._current, self._substitutions = outer
+            self._add(key, seconds, len(cells), size, substitutions)
+            self.events.append({
+                'name': function.__name__, 'ph': 'X',
+                'ts': (start - self._start) * 1e6, 'dur': seconds * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {'kinds': kinds, 'cells': len(cells),
+                    'characters': size, 'substitutions': substitutions},
+            })
+
+    def rule(self, rule:str, seconds:float, size:int, count:int, position:int):
+        """Record a replacement rule applied to the cell at position."""
+        function, kinds, _ = self._current or ('_replace', '', '')
+        self._add((function, kinds, rule), seconds, 1, size, count)
+        self._substitutions += count
+        if seconds > self.budget:
+            _problem('slow', logging.WARNING,
+                'Replacing %s took %.1fs in cell %s', rule, seconds, position,
+                cell=position)
+
+    def table(self) -> str:
+        """Return the statistics as a table, slowest first."""
+        lines = [f'{"function":<16} {"kinds":<20} {"rule":<24} {"calls":>6} '
+            f'{"seconds":>9} {"cells":>7} {"chars":>10} {"subs":>7}']
+        rows = sorted(self.stats.items(), key=lambda row: -row[1][1])
+        for (function, kinds, rule), stats in rows:
+            calls, seconds, cells, size, count = stats
+            lines.append(f'{function:<16} {kinds[:20]:<20} {rule[:24]:<24} '
+                f'{calls:6} {seconds:9.4f} {cells:7} {size:10} {count:7}')
+        return '\n'.join(lines)
+
+    def trace(self, path:str) -> None:
+        """Write the function calls in Chrome's trace format to a JSON file.
+
+        Open the file in Chrome's about:tracing page or in Perfetto.
+        """
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.events}, file)
+
+@contextmanager
+def profile(budget:float=1.0):
+    """Record statistics of Jollity's functions called within the context.
+
+    Use as `with profile() as stats:` and then e.g. `print(stats.table())`.
+    A warning is logged for any replacement taking more than budget seconds
+    on a single cell, e.g. a regular expression that backtracks a lot.
+    """
+    global _profile
+    previous = _profile
+    _profile = Profile(budget)
+    try:
+        yield _profile
+    finally:
+        _profile = previous
+
+# Diagnostics
+# -----------
+# Checks and failed operations report problems with `_problem`, which
+# logs them by default. Within `diagnose`, they're instead kept as records
+# that are only formatted into messages when logged or exported.
+
+class Diagnostic(NamedTuple):
+    """A problem found in a notebook, by a check or by `lint`."""
+    path: str           # the notebook's file, or '' if unknown
+    cell: int           # the position of the cell, from 0, or -1 if none
+    rule: str           # the kind of problem, e.g. 'length' or 'url'
+    level: int          # the logging level, e.g. logging.WARNING
+    template: str       # the message, with % placeholders for args
+    args: tuple
+    line: int = 0       # the line in the cell, from 1, or 0 if none
+    column: int = 0     # the column in the line, from 1, or 0 if none
+
+    @property
+    def message(self) -> str:
+        """The formatted message, as it would be logged."""
+        return self.template % self.args if self.args else self.template
+
+class Diagnostics:
+    """The problems found within `diagnose`, each kept once with its count."""
+
+    def __init__(self, path:str=''):
+        self.path = path    # the file being processed, recorded with problems
+        self.counts = {}    # Diagnostic -> number of times it was found
+
+    def add(self, rule:str, level:int, template:str, args:tuple=(),
+        cell:int=-1) -> None:
+        """Record a problem in the current file."""
+        found = Diagnostic(self.path, cell, rule, level, template, args)
+        self.counts[found] = self.counts.get(found, 0) + 1
+
+    def merge(self, other:'Diagnostics') -> None:
+        """Add the problems of other, e.g. collected by another process."""
+        for found, count in other.counts.items():
+            self.counts[found] = self.counts.get(found, 0) + count
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def log(self) -> None:
+        """Log each problem once, in the order found."""
+        for found in self.counts:
+            logging.log(found.level, found.template, *found.args)
+
+    def json(self) -> list:
+        """Return the problems as a list of JSON-serialisable dicts."""
+        return [{'path': found.path, 'cell': found.cell, 'rule': found.rule,
+            'level': logging.getLevelName(found.level),
+            'message': found.message, 'count': count}
+            for found, count in self.counts.items()]
+
+    def summary(self) -> dict:
+        """Return the number of times each rule found a problem."""
+        totals = {}
+        for found, count in self.counts.items():
+            totals[found.rule] = totals.get(found.rule, 0) + count
+        return dict(sorted(totals.items()))
+
+_diagnostics = None     # the Diagnostics in use, if any
+
+def _problem(rule:str, level:int, template:str, *args, cell:int=-1) -> None:
+    """Internal function: Log a problem, or record it if diagnosing."""
+    if _diagnostics is None:
+        logging.log(level, template, *args)
+    else:
+        _diagnostics.add(rule, level, template, args, cell)
+
+def _report_problems(found:Diagnostics) -> None:
+    """Internal function: Record found problems if diagnosing, else log them."""
+    if _diagnostics is None:
+        found.log()
+    else:
+        _diagnostics.merge(found)
+
+@contextmanager
+def diagnose(path:str=''):
+    """Record the problems found within the context instead of logging them.
+
+    Use as `with diagnose() as found:` and then e.g. `found.log()`,
+    `found.json()` or `found.summary()`. Set `found.path` to the file
+    being processed so that problems record it. `process_files` and
+    `process_book` do so for each file.
+    """
+    global _diagnostics
+    previous = _diagnostics
+    _diagnostics = Diagnostics(path)
+    try:
+        yield _diagnostics
+    finally:
+        _diagnostics = previous
+
+# Regular expression guard
+# ------------------------
+# A regular expression with nested quantifiers, like (a+)+$, may take
+# exponential time on some texts. Python can't interrupt a running match,
+# so guarded matches run in a separate process that is stopped if too slow.
+
+def _nested_quantifier(items, repeated:bool=False) -> bool:
+    """Internal function: Check if a parsed regexp repeats a repetition."""
+    for op, value in items:
+        if op in (_parser.MAX_REPEAT, _parser.MIN_REPEAT):
+            low, high, subpattern = value
+            if high > 1 and repeated:
+                return True
+            if _nested_quantifier(subpattern, repeated or high > 1):
+                return True
+        elif op == _parser.SUBPATTERN:
+            if _nested_quantifier(value[-1], repeated):
+                return True
+        elif op == _parser.BRANCH:
+            if any(_nested_quantifier(branch, repeated) for branch in value[1]):
+                return True
+        elif op in (_parser.ASSERT, _parser.ASSERT_NOT):
+            if _nested_quantifier(value[1], repeated):
+                return True
+    return False
+
+def lint_regex(pattern:str) -> str:
+    """Return a description of a potential problem with pattern, or ''."""
+    try:
+        items = _parser.parse(pattern)
+    except re.error as e:
+        return f'invalid regular expression: {e}'
+    if _nested_quantifier(items):
+        return 'nested quantifiers may take exponential time'
+    return ''
+
+def _regex_worker(connection) -> None:
+    """Internal function: Do the regexp operations sent by RegexGuard."""
+    while True:
+        operation, args = connection.recv()
+        try:
+            result = getattr(re, operation)(*args)
+            if isinstance(result, re.Match):    # can't be sent back
+                result = True
+            connection.send((True, result))
+        except Exception as e:
+            connection.send((False, e))
+
+class RegexGuard:
+    """Do regexp operations in a separate process, stopping them if too slow."""
+
+    def __init__(self, budget:float=1.0):
+        self.budget = budget    # seconds allowed for each operation
+        self.linted = set()     # patterns already checked
+        self._process = None
+        self._connection = None
+
+    def _run(self, operation:str, pattern:str, *args):
+        """Internal method: Return re.operation(pattern, *args).
+
+        Raise TimeoutError if it takes longer than the budget.
+        """
+        if pattern not in self.linted:
+            self.linted.add(pattern)
+            if problem := lint_regex(pattern):
+                _problem('regex', logging.WARNING,
+                    'Regular expression %s: %s', pattern, problem)
+        if self._process is None:
+            import multiprocessing
+
+            self._connection, child = multiprocessing.Pipe()
+            self._process = multiprocessing.Process(
+                target=_regex_worker, args=(child,), daemon=True)
+            self._process.start()
+        self._connection.send((operation, (pattern, *args)))
+        if not self._connection.poll(self.budget):
+            self.close()    # the next operation starts a new process
+            raise TimeoutError(pattern)
+        success, result = self._connection.recv()
+        if not success:
+            raise result
+        return result
+
+    def subn(self, pattern:str, replacement:str, text:str) -> tuple:
+        """Like re.subn, but raise TimeoutError if it takes too long."""
+        return self._run('subn', pattern, replacement, text)
+
+    def search(self, pattern:str, text:str) -> bool:
+        """Check if re.search finds pattern. Raise TimeoutError if too slow."""
+        return self._run('search', pattern, text)
+
+    def close(self) -> None:
+        """Stop the separate process."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._connection.close()
+            self._process = None
+
+@contextmanager
+def guard_regex(budget:float=1.0):
+    """Stop any regexp replacement or search that takes over budget seconds.
+
+    Within the context, `replace_re` and `remove_cells` run each regular
+    expression on each cell in a separate process and log an error, naming
+    the regexp and the cell, if it takes too long. The cell isn't changed.
+    """
+    global _guard
+    previous = _guard
+    _guard = RegexGuard(budget)
+    try:
+        yield _guard
+    finally:
+        _guard.close()
+        _guard = previous
+
+# Batch processing
+# ----------------
+
+class BatchResult(NamedTuple):
+    """The outcome of processing one file with `process_files`."""
+    path: str
+    seconds: float
+    error: str          # the exception raised, or '' if there was none
+    records: list       # the log records emitted during processing
+    value: object       # the value returned by the processing function
+    diagnostics: Diagnostics = None     # the problems, if diagnosing
+    traceback: str = ''     # where the exception was raised, if any
+
+class _Collector(logging.Handler):
+    """Internal class: Keep log records to send them to another process."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # format the message and the exception's traceback, into exc_text,
+        # now: the arguments and exception may not be picklable
+        self.format(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def _process_file(function, path:str, diagnosing:bool=False) -> BatchResult:
+    """Internal function: Apply function to path, collecting its log records.
+
+    If diagnosing, the problems found are collected too.
+    """
+    global _diagnostics
+    previous = _diagnostics
+    found = _diagnostics = Diagnostics(path) if diagnosing else None
+    root = logging.getLogger()
+    handlers = root.handlers
+    collector = _Collector()
+    root.handlers = [collector]
+    start = time.perf_counter()
+    value = None
+    details = ''
+    try:
+        value = function(path)
+        problem = ''
+    except Exception as e:
+        import traceback
+
+        problem = f'{type(e).__name__}: {e}'
+        details = traceback.format_exc()
+    finally:
+        root.handlers = handlers
+        _diagnostics = previous
+    return BatchResult(path, time.perf_counter() - start, problem,
+        collector.records, value, found, details)
+
+def _report(result:BatchResult) -> BatchResult:
+    """Internal function: Log the records and outcome of processing a file."""
+    for record in result.records:
+        logging.getLogger(record.name).handle(record)
+    if result.diagnostics is not None and _diagnostics is not None:
+        _diagnostics.merge(result.diagnostics)
+    if result.error:
+        _problem('process', logging.ERROR, 'Processing %s raises %s',
+            result.path, result.error)
+        _problem('process', logging.DEBUG, 'Processing %s failed at:\n%s',
+            result.path, result.traceback)
+    else:
+        _problem('process', logging.INFO, 'Processed %s in %.3fs',
+            result.path, result.seconds)
+    return result
+
+def process_files(paths:list, function, jobs:int=None) -> list:
+    """Apply function to each path in parallel. Return a list of BatchResult.
+
+    The log records of each file are passed to the logging setup of this
+    process in the order of `paths`, after the file has been processed.
+    Within `diagnose`, the problems found are merged in the same order.
+    The function must be defined at the top level of a module.
+    """
+    diagnosing = _diagnostics is not None
+    if jobs == 1:   # no parallelism: avoid the cost of starting processes
+        outcomes = map(_process_file, repeat(function), paths,
+            repeat(diagnosing))
+        results = [_report(outcome) for outcome in outcomes]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(jobs) as pool:
+            outcomes = pool.map(_process_file, repeat(function), paths,
+                repeat(diagnosing))
+            results = [_report(outcome) for outcome in outcomes]
+    return results
+
+# Books
+# -----
+# A book's notebooks can be processed one at a time, so that only one is
+# in memory. The state that crosses notebooks is kept in a BookContext.
+
+class BookContext:
+    """The state shared by the notebooks of a book.
+
+    Pass the context's `checker` to `check_urls` and the context to
+    `check_levels`, so that each URL is opened once and a notebook's first
+    heading is checked against the previous notebook's last heading.
+    Function `process_book` records the code files it writes in `code`.
+    """
+
+    def __init__(self, checker:LinkChecker=None):
+        self.checker = checker or LinkChecker()
+        self.level = math.inf   # the level of the last heading so far
+        self.code = {}          # code file -> its (line, cell) pairs
+
+def _read(path:str):
+    """Internal function: Read a notebook, converting other formats to it."""
+    if path.endswith('.ipynb'):
+        return read_nb(path)
+    if path.endswith('.md'):
+        return read_md(path)
+    import jupytext     # e.g. for Python scripts
+
+    return jupytext.read(path)
+
+def process_book(paths:list, steps, target=None, code=None,
+    context:BookContext=None):
+    """Read, process and write each notebook, yielding (path, notebook).
+
+    Argument steps is a Pipeline or a function that processes a notebook.
+    Functions target and code map a path to the notebook and code files
+    to write; by default, the notebook is written next to the original file,
+    with extension .ipynb, and no code is written. So notebooks are
+    overwritten but Markdown and other files converted to notebooks aren't.
+    The notebooks are processed one at a time, when the next is requested:
+    each notebook can be freed once the caller no longer refers to it.
+    """
+    if isinstance(steps, Pipeline):
+        steps = steps.run
+    for path in paths:
+        if _diagnostics is not None:
+            _diagnostics.path = path
+        nb = _read(path)
+        steps(nb)
+        if code is not None:
+            with atomic_write(code(path)) as file:
+                lines = write_code(nb, file)
+            if context is not None:
+                context.code[code(path)] = lines
+        if target is None:
+            write_nb(nb, os.path.splitext(path)[0] + '.ipynb')
+        else:
+            write_nb(nb, target(path))
+        yield path, nb
+        del nb      # don't keep the notebook while reading the next one
+
+# Watching files
+# --------------
+
+def watch(pattern:str, function, interval:float=0.5, initial:bool=True,
+    stop:threading.Event=None) -> None:
+    """Apply function to each file matching pattern when it is new or changed.
+
+    The files are checked every `interval` seconds, until `stop` is set or
+    the program is interrupted. If `initial` is true, all files matching
+    the pattern are processed at the start; otherwise only later changes are.
+    The glob pattern may include `**` to match files in subfolders.
+    """
+    seen = {} if initial else None
+    while True:
+        current = {}
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:   # deleted since listed
+                continue
+            current[path] = (status.st_mtime_ns, status.st_size)
+        if seen is not None:
+            for path, version in current.items():
+                if seen.get(path) != version:
+                    _report(_process_file(function, path))
+        seen = current
+        if stop is None:
+            time.sleep(interval)
+        elif stop.wait(interval):
+            return
+
+# Command line
+# ------------
+# `python -m jollity pipeline.toml 'md/**/*.ipynb' --output doc` applies
+# the steps declared in the pipeline file to each notebook.
+
+def _load_pipeline(path:str) -> dict:
+    """Internal function: Read the pipeline in a JSON or TOML file."""
+    if path.endswith('.toml'):
+        import tomllib      # Python 3.11 or later
+
+        with open(path, 'rb') as file:
+            return tomllib.load(file)
+    with open(path) as file:
+        return json.load(file)
+
+def _constant(value):
+    """Internal function: Replace names of Jollity's constants with them.
+
+    For example, "POWERS" stands for jollity.POWERS and "COMMENT" for
+    jollity.COMMENT, also within lists.
+    """
+    if isinstance(value, list):
+        return [_constant(item) for item in value]
+    if isinstance(value, str) and value.isupper():
+        constant = globals().get(value)
+        if isinstance(constant, (str, list)):
+            return constant
+    return value
+
+@lru_cache(maxsize=None)
+def _pipeline(definition:str) -> tuple:
+    """Internal function: Return the Pipeline and LinkChecker of a definition.
+
+    The definition is in JSON, so that it can be a cache key.
+    """
+    definition = json.loads(definition)
+    checker = LinkChecker(**definition.get('links', {}))
+    pipeline = Pipeline()
+    for step in definition.get('steps', []):
+        step = dict(step)
+        name = step.pop('step', '')
+        function = globals().get(name)
+        if (name.startswith('_') or not callable(function) or
+                isinstance(function, type) or
+                getattr(function, '__module__', '') != __name__):
+            raise ValueError(f'Unknown step: {name}')
+        for key, value in step.items():
+            step[key] = _constant(value)
+        if isinstance(step.get('replacements'), list):
+            # JSON and TOML have no tuples: use them for the pairs
+            replacements = step['replacements']
+            if len(replacements) == 2 and all(
+                    isinstance(part, str) for part in replacements):
+                step['replacements'] = tuple(replacements)
+            else:
+                step['replacements'] = [tuple(pair) for pair in replacements]
+        if function is check_urls:
+            step.setdefault('checker', checker)
+        pipeline.add(function, **step)
+    return pipeline, checker
+
+def _process_notebook(definition:str, output:str, changed_only:bool,
+    path:str) -> dict:
+    """Internal function: Process a notebook as declared by the command line.
+
+    Return the target notebook's path and whether it was reused.
+    """
+    declared = json.loads(definition)
+    target = os.path.splitext(path)[0] + '.ipynb'
+    if output:
+        # on Windows, relpath raises ValueError for another drive
+        relative = os.path.relpath(target)
+        if relative.split(os.sep)[0] == os.pardir:
+            raise ValueError(f'{path} is outside the current folder, '
+                'so it has no place in the output folder')
+        target = os.path.join(output, relative)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    targets = [target]
+    if 'code' in declared:
+        targets.append(os.path.splitext(target)[0] + '.py')
+    if changed_only:
+        cache = BuildCache(declared.get('cache', '.jollity'),
+            fingerprint(definition))
+        if cache.restore(path, targets):
+            return {'target': target, 'reused': True}
+    # collect the problems found, to store them with the targets
+    try:
+        with diagnose(path) as found:
+            nb = _read(path)
+            pipeline, checker = _pipeline(definition)
+            pipeline.run(nb)
+            if 'code' in declared:
+                options = declared['code']
+                if not isinstance(options, dict):
+                    options = {}
+                with atomic_write(targets[1]) as file:
+                    write_code(nb, file, **options)
+            if declared.get('clean', True):
+                remove_metadata(nb, 'all')
+            write_nb(nb, target)
+    finally:
+        _report_problems(found)
+    if changed_only:
+        cache.store(path, targets, found)
+    return {'target': target, 'reused': False}
+
+def _summary(results:list, seconds:float) -> dict:
+    """Internal function: Return the outcome of a command line run."""
+    files = []
+    for result in results:
+        value = result.value or {}
+        files.append({
+            'path': result.path,
+            'target': value.get('target', ''),
+            'reused': value.get('reused', False),
+            'seconds': round(result.seconds, 6),
+            'error': result.error,
+            'traceback': result.traceback,
+            'warnings': [record.getMessage() for record in result.records
+                if record.levelno == logging.WARNING],
+            'errors': [record.getMessage() for record in result.records
+                if record.levelno >= logging.ERROR],
+        })
+    return {
+        'seconds': round(seconds, 6),
+        'files': len(files),
+        'reused': sum(file['reused'] for file in files),
+        'failed': sum(bool(file['error']) for file in files),
+        'warnings': sum(len(file['warnings']) for file in files),
+        'errors': sum(len(file['errors']) for file in files),
+        'results': files,
+    }
+
+def _main(arguments:list=None) -> int:
+    """Internal function: Run the command line. Return the exit status."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m jollity',
+        description='Apply a pipeline of Jollity functions to notebooks.')
+    parser.add_argument('pipeline', help='JSON or TOML file with the steps')
+    parser.add_argument('patterns', nargs='+',
+        help="notebook files or glob patterns, like 'md/**/*.ipynb'")
+    parser.add_argument('--output', default='',
+        help='folder for the processed notebooks (default: overwrite them)')
+    parser.add_argument('--jobs', type=int, default=None,
+        help='number of notebooks processed in parallel (default: all cores)')
+    parser.add_argument('--changed-only', action='store_true',
+        help='reuse the outputs of unchanged notebooks; requires --output')
+    parser.add_argument('--summary', default='',
+        help="JSON file for timings, warnings and errors ('-' for the screen)")
+    parser.add_argument('--log', default='',
+        help='file for the log messages (default: the screen)')
+    options = parser.parse_args(arguments)
+    if options.changed_only and not options.output:
+        parser.error('--changed-only requires --output')
+    logging.basicConfig(format='%(levelname)s %(message)s',
+        filename=options.log or None, filemode='w')
+    definition = json.dumps(_load_pipeline(options.pipeline), sort_keys=True)
+    paths = []
+    for pattern in options.patterns:
+        paths.extend(sorted(glob.glob(pattern, recursive=True)))
+    paths = list(dict.fromkeys(paths))
+    start = time.perf_counter()
+    results = process_files(paths, partial(_process_notebook, definition,
+        options.output, options.changed_only), options.jobs)
+    summary = _summary(results, time.perf_counter() - start)
+    if options.summary == '-':
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+    elif options.summary:
+        with atomic_write(options.summary) as file:
+            json.dump(summary, file, indent=1)
+    return 1 if summary['failed'] or summary['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -104,6 +104,8 @@ Before starting to work on this chapter, check the
 
     # report long lines
     jollity.check_lengths(nb, 'code', MAXL)
+    # report code that doesn't compile, e.g. after removing skipped lines
+    jollity.check_code(nb)
 
     # ---- clean up
 
@@ -112,15 +114,14 @@ Before starting to work on this chapter, check the
 
 def for_distribution(nb_file, py_file):
     """Process notebook before it's put on the website."""
-    with open(nb_file, 'r') as file:
-        nb = nbformat.read(file, 4)
+    # executed notebooks have large outputs that needn't be decoded
+    nb = jollity.read_nb(nb_file)
 
-    if code := jollity.extract_code(nb):
+    if any(cell.cell_type == 'code' for cell in nb.cells):
         with open(py_file, 'w') as file:
             file.write(NOTICE)
-            # comment out IPython's magic commands before writing Python file
-            # keep the indentation
-            file.write(re.sub(r'(?m)^(\s*)%', r'\1# %', code))
+            # comment out IPython's magic commands, keeping the indentation
+            jollity.write_code(nb, file, magics=True)
 
     # NOTE and INFO Markdown text is inside <div>, so convert it to HTML
     jollity.replace_re(nb, 'md:note md:info', [
@@ -146,8 +147,7 @@ def for_distribution(nb_file, py_file):
     # remove metadata: don't leave traces of Jollity
     jollity.remove_metadata(nb, 'all')
 
-    with open(nb_file, 'w') as file:
-        nbformat.write(nb, file)
+    jollity.write_nb(nb, nb_file)
 
 # at the end, the script does
 print('See log.txt for the warning and error messages.')
@@ -0,0 +1,642 @@
+"""Tests for jollity. Run with `python -m pytest test_jollity.py`."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import copy
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+
+import nbformat.v4 as nb4
+import pytest
+
+import jollity
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Replacing text
+# --------------
+# A RuleSet does consecutive replacements in as few scans as possible.
+# The result must be the same as doing them one after the other.
+
+REPLACE_CHARS = 'ab^1/2\n'
+REPLACE_RE = [('a', 'x'), ('a+', 'b'), ('b|1', ''), ('^a', '1'),
+    (r'(a)b', r'\1\1'), ('2$', 'a'), (r'\^(\d)', r'<\1>')]
+
+def replace_one_by_one(rules:list, text:str) -> str:
+    """Do the replacements one after the other, as before RuleSet."""
+    for what, old, new in rules:
+        if what == 'S':
+            text = text.replace(old, new)
+        elif what == 'C':
+            text = text.translate(str.maketrans(old, new))
+        else:
+            text = re.sub(old, new, text)
+    return text
+
+def random_rules(rng) -> list:
+    """Return a random list of (what, old, new) replacements."""
+    def chars(length):
+        return ''.join(rng.choices(REPLACE_CHARS, k=length))
+
+    rules = []
+    for _ in range(rng.randint(1, 6)):
+        what = rng.choice('SSSCR')
+        if what == 'S':     # the old string may be empty
+            rules.append(('S', chars(rng.randint(0, 3)),
+                chars(rng.randint(0, 3))))
+        elif what == 'C':
+            length = rng.randint(1, 3)
+            rules.append(('C', chars(length), chars(length)))
+        else:
+            rules.append(('R', *rng.choice(REPLACE_RE)))
+    return rules
+
+def test_rule_set_as_one_by_one():
+    rng = random.Random(3)
+    for _ in range(5000):
+        rules = random_rules(rng)
+        text = ''.join(rng.choices(REPLACE_CHARS, k=rng.randint(0, 20)))
+        rule_set = jollity.RuleSet()
+        for what, old, new in rules:
+            rule_set.add(what, (old, new))
+        assert rule_set.apply(text) == replace_one_by_one(rules, text), rules
+
+# Pipelines
+# ---------
+# A Pipeline fuses consecutive steps that process each cell on its own.
+# The notebook and the problems found must be the same as when calling
+# the functions one after the other.
+
+PIPELINE_LINES = ['text', '', '# Head a^2', '## Sub', '#### Deep', 'a 1/2 b',
+    '[label](m269) and [url](http://x.org)', '```', 'x = a^2', 'text  ',
+    'a' * 30 + ' ' + 'b' * 30, '<!-- answer -->']
+PIPELINE_KINDS = ['all', 'md:text', 'code', 'md:head md:text', 'md:fence']
+
+def random_steps(rng) -> list:
+    """Return a random list of (function, args, kwargs) steps."""
+    steps = []
+    functions = [jollity.replace_str, jollity.replace_char, jollity.replace_re,
+        jollity.expand_urls, jollity.check_breaks, jollity.check_lengths,
+        jollity.check_levels]
+    for _ in range(rng.randint(1, 8)):
+        function = rng.choice(functions)
+        kinds = rng.choice(PIPELINE_KINDS)
+        if function is jollity.check_levels:
+            steps.append((function, (), {}))
+        elif function is jollity.expand_urls:
+            steps.append((function, (kinds, {'m269': 'http://m269'}), {}))
+        elif function is jollity.check_breaks:
+            steps.append((function, (kinds,), {}))
+        elif function is jollity.check_lengths:
+            steps.append((function, (kinds,),
+                {'length': rng.randint(20, 70)}))
+        else:
+            what = {jollity.replace_str: 'S', jollity.replace_char: 'C',
+                jollity.replace_re: 'R'}[function]
+            rules = [(old, new) for kind, old, new in random_rules(rng)
+                if kind == what]
+            steps.append((function, (kinds, rules), {}))
+    return steps
+
+def _warnings(found) -> dict:
+    """Return the problems at warning level or above, with their counts."""
+    return {problem: count for problem, count in found.counts.items()
+        if problem.level >= logging.WARNING}
+
+def test_pipeline_as_one_by_one():
+    rng = random.Random(4)
+    for _ in range(1000):
+        cells = []
+        for _ in range(rng.randint(1, 4)):
+            lines = rng.choices(PIPELINE_LINES, k=rng.randint(0, 8))
+            if rng.random() < 0.3:
+                cells.append(nb4.new_code_cell('\n'.join(lines)))
+            else:
+                cells.append(nb4.new_markdown_cell('\n'.join(lines)))
+        nb = nb4.new_notebook(cells=cells)
+        jollity.split_md(nb, ['answer'], [])
+        steps = random_steps(rng)
+        one, fused = copy.deepcopy(nb), copy.deepcopy(nb)
+        with jollity.diagnose() as found:
+            for function, args, kwargs in steps:
+                function(one, *args, **kwargs)
+        pipeline = jollity.Pipeline()
+        for function, args, kwargs in steps:
+            pipeline.add(function, *args, **kwargs)
+        with jollity.diagnose() as fused_found:
+            pipeline.run(fused)
+        assert fused == one, steps
+        # the informative messages about fused replacements may differ
+        assert _warnings(fused_found) == _warnings(found), steps
+
+# Splitting Markdown cells
+# ------------------------
+# split_md was rewritten as a single-pass tokenizer. The original version
+# is kept here to check that both split random cells in the same way,
+# except that split_md also records the position of the split cell.
+
+def old_split_md(nb, line_comments:list, block_comments:list) -> None:
+    """Split markdown cells in headings, text, fenced blocks. Remove comments."""
+    FENCE = re.compile(r' {0,3}(`{3,}|~{3,})')
+    COMMENT_START = re.compile(r' {0,3}<!--')
+    # find first --> in line with non-greedy match .*?
+    COMMENT_END = re.compile(r'.*?-->(.*)')
+
+    def close(kind, extra=dict()):
+        if lines:
+            cell = nb4.new_markdown_cell('\n'.join(lines))
+            cell.metadata = {'jollity': {'kind': kind}}
+            cell.metadata.update(old_cell.metadata)
+            if extra:
+                cell.metadata.jollity.update(extra)
+            cells.append(cell)
+
+    cells = []
+    for old_cell in nb.cells:
+        if old_cell.cell_type != 'markdown':
+            cells.append(old_cell)
+            continue
+
+        lines = []
+        fence = ''      # the opening fence of the current fenced block
+        comment = None
+        for line in old_cell.source.split('\n'):
+            if comment == 'normal':
+                if match := COMMENT_END.match(line):
+                    comment = None
+                lines.append(line)
+            elif comment:
+                # (?i) ignores case
+                if re.match(fr'(?i) ? ? ?<!--\s*{comment}\s*-->\s*$', line):
+                    close(comment)
+                    lines = []
+                    comment = None
+                else:
+                    lines.append(line)
+            elif fence:
+                match = FENCE.match(line)
+                if match and match.group(1).startswith(fence):
+                    fence = ''
+                    lines.append(line)
+                    close('fence')
+                    lines = []
+                else:
+                    lines.append(line)
+            # line is outside comment and fenced block
+            elif COMMENT_START.match(line):
+                for kind in line_comments + block_comments:
+                    if re.match(fr'(?i)<!--\s*{kind}\s*-->', line.strip()):
+                        close('text')
+                        if kind in line_comments:
+                            lines = ['']
+                            close(kind)
+                        else:
+                            comment = kind
+                        lines = []
+                        break
+                else:   # not a special comment
+                    lines.append(line)
+                    if not COMMENT_END.match(line):
+                        comment = 'normal'
+            elif match := FENCE.match(line):
+                close('text')
+                fence = match.group(1)  # remember opening sequence of ` or ~
+                lines = [line]
+            elif match := jollity.ATX.match(line):
+                close('text')
+                lines = [line]
+                close('head', {
+                    'level': len(match.group(1)),
+                    'heading': match.group(2),
+                })
+                lines = []
+            else:
+                lines.append(line)
+
+        close('text')
+    nb.cells = cells
+
+SPLIT_LINES = ['text', '', '  <!-- NOTE -->', '<!-- note -->', '<!--Answer-->',
+    '<!-- answer --> trailing', '<!-- x', '-->', '<!-- c -->', '```', '~~~',
+    '````py', '   ```', '# Head', '## Head ##', '####### no', '#nope',
+    '    <!-- NOTE -->', '<!-- HINT -->', ' <!-- hint -->  ', 'text  ',
+    '<!-- normal -->']
+
+def old_split(nb, line_comments:list, block_comments:list) -> None:
+    """Split as old_split_md, recording the split positions as split_md."""
+    cells = []
+    for position, cell in enumerate(nb.cells):
+        one = nb4.new_notebook(cells=[cell])
+        old_split_md(one, line_comments, block_comments)
+        if cell.cell_type == 'markdown' and 'jollity' not in cell.metadata:
+            for new in one.cells:
+                new.metadata.jollity.split = position
+        cells.extend(one.cells)
+    nb.cells = cells
+
+def _strip(nb):
+    """Remove what differs between equivalent notebooks: ids and versions."""
+    nb.metadata.get('jupytext', {}).pop('text_representation', None)
+    for cell in nb.cells:
+        cell.pop('id', None)
+    return nb
+
+def test_split_md_as_before():
+    rng = random.Random(2)
+    for _ in range(3000):
+        cells = []
+        for _ in range(rng.randint(1, 3)):
+            source = '\n'.join(rng.choices(SPLIT_LINES, k=rng.randint(0, 10)))
+            new_cell = rng.choice([nb4.new_markdown_cell, nb4.new_code_cell])
+            cell = new_cell(source)
+            if rng.random() < 0.2:
+                cell.metadata.tags = ['x']
+            cells.append(cell)
+        nb = nb4.new_notebook(cells=cells)
+        old, new = copy.deepcopy(nb), copy.deepcopy(nb)
+        old_split(old, ['answer'], ['note', 'hint'])
+        jollity.split_md(new, ['answer'], ['note', 'hint'])
+        assert _strip(new) == _strip(old), nb
+
+def test_split_md_manual_as_before():
+    nb = jollity.read_md(os.path.join(HERE, 'md', 'manual.md'))
+    old, new = copy.deepcopy(nb), copy.deepcopy(nb)
+    old_split(old, ['answer'], ['note'])
+    jollity.split_md(new, ['answer'], ['note'])
+    assert _strip(new) == _strip(old)
+
+# Reading and writing notebooks
+# -----------------------------
+
+def _sample_nb():
+    """Return a notebook with outputs and attachments."""
+    return nb4.new_notebook(metadata={'kernelspec': {'name': 'python3',
+        'display_name': 'Python 3', 'language': 'python'}},
+        cells=[
+        nb4.new_markdown_cell('# Title\n![plot](attachment:plot.png)',
+            attachments={'plot.png': {'image/png': 'iVBORw0KGgo='}}),
+        nb4.new_code_cell('print("µ")\nplot()', execution_count=1,
+            metadata={'tags': ['x']}, outputs=[
+            nb4.new_output('stream', text='µ\n'),
+            nb4.new_output('display_data', data={
+                'image/png': 'iVBORw0KGgo=', 'text/plain': '<Figure>'}),
+            nb4.new_output('error', ename='E', evalue='e', traceback=['t']),
+        ]),
+        nb4.new_code_cell('x = 1'),
+        nb4.new_raw_cell('raw text'),
+    ])
+
+@pytest.mark.parametrize('indent, ascii', [(1, False), (None, False),
+    (4, False), (1, True)])
+def test_write_nb_as_nbformat(tmp_path, indent, ascii):
+    import json
+    import nbformat
+
+    source, expected, written = (str(tmp_path / name)
+        for name in ('source.ipynb', 'expected.ipynb', 'written.ipynb'))
+    # nbformat's JSON, minified, indented in other ways or with \u escapes
+    nbformat.write(_sample_nb(), source)
+    with open(source, encoding='utf-8') as file:
+        text = json.load(file)
+    with open(source, 'w', encoding='utf-8') as file:
+        json.dump(text, file, indent=indent, ensure_ascii=ascii)
+    for read, write, path in ((nbformat.read, nbformat.write, expected),
+            (jollity.read_nb, jollity.write_nb, written)):
+        nb = read(source, 4) if read is nbformat.read else read(source)
+        nb.cells[0].source += '\nmore text'
+        nb.cells[1].metadata['tags'].append('y')
+        write(nb, path)
+    with open(expected, 'rb') as one, open(written, 'rb') as other:
+        assert one.read() == other.read()
+
+def test_read_nb_copies_keep_outputs(tmp_path):
+    import nbformat
+
+    path = str(tmp_path / 'nb.ipynb')
+    nbformat.write(_sample_nb(), path)
+    with open(path, 'rb') as file:
+        original = file.read()
+    nb = jollity.read_nb(path)
+    assert 'outputs' not in nb.cells[1] and 'attachments' not in nb.cells[0]
+    jollity.write_nb(copy.deepcopy(nb), path)
+    with open(path, 'rb') as file:
+        assert file.read() == original
+
+def test_write_nb_without_outputs(tmp_path):
+    import nbformat
+
+    path = str(tmp_path / 'nb.ipynb')
+    nbformat.write(_sample_nb(), path)
+    with open(path, 'rb') as file:
+        original = file.read()
+    nb = jollity.read_nb(path)
+    # a rebuilt cell no longer has the outputs kept by read_nb
+    nb.cells[1] = nbformat.NotebookNode(dict(nb.cells[1]))
+    with pytest.raises(ValueError):
+        jollity.write_nb(nb, path)
+    with open(path, 'rb') as file:
+        assert file.read() == original
+
+# Merging cells
+# -------------
+
+def test_merge_union_keeps_heading(caplog):
+    nb = nb4.new_notebook(cells=[
+        nb4.new_markdown_cell('# H\ntext\n```\nx\n```\n## Sub')])
+    jollity.split_md(nb, [], [])
+    jollity.merge_cells(nb, 'md:head md:text', 'union')
+    first = nb.cells[0].metadata.jollity
+    assert (first.kind, first.level, first.heading) == ('head text', 1, 'H')
+    with caplog.at_level(logging.WARNING):
+        jollity.check_levels(nb)
+    assert not caplog.records
+    assert jollity.CellTable([nb]).level.tolist() == [1, 0, 2]
+
+# Linting
+# -------
+
+def test_findings_sarif_addresses_cells():
+    nb = nb4.new_notebook(cells=[nb4.new_markdown_cell('# Title'),
+        nb4.new_code_cell('x\t= 1\ny = 2 ')])
+    findings = jollity.lint(nb, [('code', 'tab'), ('code', 'trailing')],
+        'a.ipynb')
+    sarif = json.loads(jollity.findings_sarif(findings))
+    results = sarif['runs'][0]['results']
+    assert [result['ruleId'] for result in results] == ['tab', 'trailing']
+    for result, finding in zip(results, findings):
+        [location] = result['locations']
+        # the line and column aren't the notebook's, so there's no region
+        assert location['physicalLocation'] == \
+            {'artifactLocation': {'uri': 'a.ipynb'}}
+        assert location['logicalLocations'][0]['name'] == 'cell 1'
+        assert result['properties'] == {'cell': 1,
+            'line': finding.line, 'column': finding.column}
+        assert result['level'] in ('error', 'warning', 'note')
+
+# Incremental builds
+# ------------------
+
+def test_fingerprint_is_stable():
+    def steps():
+        checker = jollity.LinkChecker(ttl=60)
+        return jollity.Pipeline().add(jollity.check_urls, 'all', checker).add(
+            jollity.check_levels, context=jollity.BookContext(checker))
+    first = steps()
+    # what a run found doesn't change the fingerprint
+    first.steps[0][1][1].outcomes['http://example.com'] = [0, '']
+    first.steps[1][2]['context'].level = 2
+    assert jollity.fingerprint(first) == jollity.fingerprint(steps())
+    assert jollity.fingerprint(jollity.LinkChecker(ttl=60)) != \
+        jollity.fingerprint(jollity.LinkChecker(ttl=30))
+    with pytest.raises(TypeError):
+        jollity.fingerprint(object())
+
+def test_build_cache(tmp_path, caplog):
+    source, target = tmp_path / 'a.md', tmp_path / 'a.ipynb'
+    cache = jollity.BuildCache(str(tmp_path / 'cache'), 'f')
+    source.write_text('v1')
+    assert not cache.restore(str(source), [str(target)])
+    target.write_text('out1')
+    with jollity.diagnose() as found:
+        jollity._problem('length', logging.WARNING, 'Long line: %s', 'x')
+    cache.store(str(source), [str(target)], found)
+    target.unlink()
+    with caplog.at_level(logging.WARNING):
+        assert cache.restore(str(source), [str(target)])
+    assert target.read_text() == 'out1'
+    assert [record.getMessage() for record in caplog.records] == \
+        ['Long line: x']
+    # a store that fails leaves nothing to reuse
+    source.write_text('v2')
+    with pytest.raises(FileNotFoundError):
+        cache.store(str(source), [str(target), str(tmp_path / 'a.py')])
+    assert not cache.restore(str(source), [str(target)])
+    # only the files of the last version of the source are kept
+    cache.store(str(source), [str(target)])
+    [folder] = os.listdir(tmp_path / 'cache')
+    assert len(os.listdir(tmp_path / 'cache' / folder)) == 1
+    assert cache.restore(str(source), [str(target)])
+
+def test_memo_file_depends_on_jollity(tmp_path):
+    path = str(tmp_path / 'memo')
+    cell = nb4.new_markdown_cell('text')
+    memo = jollity.Memo(path=path)
+    assert memo.get('step', cell, str.upper) == 'TEXT'
+    memo.close()
+    memo = jollity.Memo(path=path)
+    assert memo.get('step', cell, str.lower) == 'TEXT'
+    memo.close()
+    # a changed Jollity doesn't reuse the results
+    memo = jollity.Memo(path=path)
+    memo.fingerprint = 'another version'
+    assert memo.get('step', cell, str.lower) == 'text'
+    memo.close()
+
+# Processing many files
+# ---------------------
+
+def _fail(path):
+    try:
+        int(path)
+    except ValueError:
+        logging.exception('Converting %s', path)
+        raise
+
+def test_process_files_keeps_tracebacks(caplog):
+    with caplog.at_level(logging.DEBUG):
+        [result] = jollity.process_files(['x'], _fail, jobs=2)
+    assert result.error.startswith('ValueError: invalid literal')
+    assert 'in _fail' in result.traceback
+    # the traceback logged in the worker process is passed on
+    logged = [record for record in caplog.records
+        if record.getMessage() == 'Converting x']
+    assert 'in _fail' in logged[0].exc_text
+    assert 'in _fail' in caplog.text
+
+# Reading Markdown
+# ----------------
+# read_md must read Markdown files like Jupytext does.
+
+MD_LINES = ['text', '', '', '   ', '# Head', '## H2', '```', '```python',
+    '```py', '``` ', '```text', '    indented', '    ', '\tx', '<!-- NOTE -->',
+    '<!-- note -->', '<!-- ANSWER -->', '<!-- c -->', 'x = """', '"""', "'''",
+    'y = "a```"', '```  ', '~~~', '# comment """', 's = "\\"""',
+    'a """ b """ c', "'", '"', '```pypy', '````', '---', '<!-- #region -->',
+    '````python', '- item', '  ```python', 'coding: x', '#!x',
+    '```{code-cell}', 'r"""x', '```python3']
+
+def test_read_md_as_jupytext(tmp_path):
+    jupytext = pytest.importorskip('jupytext')
+    rng = random.Random(0)
+    path = tmp_path / 'test.md'
+    for _ in range(1000):
+        # mostly lines that read_md handles itself, not via Jupytext
+        if rng.random() < 0.7:
+            pool = MD_LINES[:14] + MD_LINES[17:27]
+        else:
+            pool = MD_LINES
+        text = '\n'.join(rng.choices(pool, k=rng.randint(0, 14)))
+        if rng.random() < 0.5:
+            text += '\n'
+        path.write_text(text, encoding='utf-8')
+        try:
+            expected = _strip(jupytext.read(path))
+        except Exception as e:
+            with pytest.raises(type(e)):
+                jollity.read_md(str(path))
+            continue
+        assert _strip(jollity.read_md(str(path))) == expected, text
+        jollity.split_md(expected, ['answer'], ['note'])
+        split = jollity.read_md(str(path), ['answer'], ['note'])
+        assert _strip(split) == _strip(expected), text
+
+def test_read_md_manual_as_jupytext():
+    jupytext = pytest.importorskip('jupytext')
+    path = os.path.join(HERE, 'md', 'manual.md')
+    assert _strip(jollity.read_md(path)) == _strip(jupytext.read(path))
+
+# Checking links
+# --------------
+# Links are found in one scan of each cell, instead of with LINK_LABEL
+# for expand_urls and with another regular expression for check_urls.
+
+LINK_PARTS = ['](', ')', 'http', 'x', '\n', ']', '(', ' ', 'h']
+URL_LINK = re.compile(r'\]\((http.+?)\)')     # as check_urls did
+
+def _targets(pattern, source:str) -> list:
+    """Return the (start, end, target) of each link pattern finds."""
+    return [(*match.span(1), match.group(1))
+        for match in pattern.finditer(source)]
+
+def test_scan_links_as_regexps():
+    rng = random.Random(5)
+    for _ in range(20000):
+        source = ''.join(rng.choices(LINK_PARTS, k=rng.randint(0, 14)))
+        labels, urls = jollity._scan_links(source)
+        assert labels == _targets(jollity.LINK_LABEL, source), source
+        assert urls == _targets(URL_LINK, source), source
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer /ok with 200, /no-head with 200 only to GET, others with 404."""
+    requests = []   # the method and path of each request received
+
+    def _answer(self, method:str) -> None:
+        self.requests.append((method, self.path))
+        if self.path == '/ok' or self.path == '/no-head' and method == 'GET':
+            self.send_response(200)
+        elif self.path == '/no-head':
+            self.send_response(405)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._answer('HEAD')
+
+    def do_GET(self):
+        self._answer('GET')
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    """Serve _Handler on a local port and return the base URL."""
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    _Handler.requests = []
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_link_checker(server, tmp_path):
+    cache = str(tmp_path / 'links.json')
+    checker = jollity.LinkChecker(cache=cache, timeout=5)
+    urls = [f'{server}/ok', f'{server}/no-head', f'{server}/missing']
+    outcomes = checker.check(urls + urls)
+    assert list(outcomes) == urls
+    assert outcomes[urls[0]] == outcomes[urls[1]] == ''
+    assert '404' in outcomes[urls[2]]
+    # each URL is opened once, with GET only if HEAD fails
+    assert sorted(_Handler.requests) == [('GET', '/missing'),
+        ('GET', '/no-head'), ('HEAD', '/missing'), ('HEAD', '/no-head'),
+        ('HEAD', '/ok')]
+    # the outcomes are reused from memory and from the cache file
+    _Handler.requests = []
+    assert checker.check(urls[:2]) == {url: '' for url in urls[:2]}
+    reloaded = jollity.LinkChecker(cache=cache, timeout=5)
+    assert reloaded.check(urls[:2]) == {url: '' for url in urls[:2]}
+    assert _Handler.requests == []
+
+def test_link_checker_failures(server):
+    checker = jollity.LinkChecker(timeout=5)
+    missing = f'{server}/missing'
+    checker.check([missing])
+    checker.check([missing])
+    assert _Handler.requests == [('HEAD', '/missing'), ('GET', '/missing')]
+    # failures are kept for less time than successes
+    checker.failure_ttl = 0
+    checker.check([missing])
+    assert len(_Handler.requests) == 4
+
+def test_check_urls(server, caplog):
+    nb = nb4.new_notebook(cells=[
+        nb4.new_markdown_cell(f'[a]({server}/ok) and [b]({server}/missing)'),
+        nb4.new_markdown_cell(f'[b]({server}/missing) again')])
+    with caplog.at_level(logging.ERROR):
+        jollity.check_urls(nb, 'all', jollity.LinkChecker(timeout=5))
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == 1
+    assert messages[0].startswith(f'Opening {server}/missing raises')
+
+# Command line
+# ------------
+
+def test_output_stays_in_its_folder(tmp_path, monkeypatch):
+    (tmp_path / 'work' / 'sub').mkdir(parents=True)
+    (tmp_path / 'work' / 'sub' / 'a.md').write_text('# A\n')
+    (tmp_path / 'b.md').write_text('# B\n')
+    monkeypatch.chdir(tmp_path / 'work')
+    definition = json.dumps({'steps': []})
+    value = jollity._process_notebook(definition, 'out', False, 'sub/a.md')
+    assert value['target'] == os.path.join('out', 'sub', 'a.ipynb')
+    assert os.path.exists(value['target'])
+    for path in ['../b.md', str(tmp_path / 'b.md')]:
+        with pytest.raises(ValueError, match='outside the current folder'):
+            jollity._process_notebook(definition, 'out', False, path)
+    assert not (tmp_path / 'b.ipynb').exists()
+
+# Importing
+# ---------
+
+IMPORT_BUDGET = 0.1     # seconds `import jollity` may take
+
+def test_import_is_light():
+    """Importing jollity doesn't import its slow dependencies."""
+    code = ('import sys, jollity; '
+        "print(' '.join(name for name in ('nbformat', 'jupytext', "
+        "'urllib.request', 'concurrent.futures', 'multiprocessing') "
+        'if name in sys.modules))')
+    done = subprocess.run([sys.executable, '-c', code], cwd=HERE,
+        capture_output=True, text=True, check=True)
+    assert done.stdout.strip() == ''
+
+def test_import_time():
+    """Importing jollity takes at most IMPORT_BUDGET seconds."""
+    times = []
+    for _ in range(5):
+        # each line is 'import time: self | cumulative | module' in μs
+        report = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            'import jollity'], cwd=HERE, capture_output=True, text=True,
+            check=True)
+        for line in report.stderr.splitlines():
+            if line.endswith('| jollity'):
+                times.append(int(line.split('|')[1]) / 1e6)
+    assert min(times) <= IMPORT_BUDGET